@@ -0,0 +1,55 @@
+-- init database for the embedded sqlite engine:
+-- sqlite3 awesome.db < schema_sqlite.sql
+
+pragma journal_mode=WAL;
+
+drop table if exists users;
+drop table if exists blogs;
+drop table if exists comments;
+
+create table users (
+    `id` text not null,
+    `email` text not null,
+    `password` text not null,
+    `admin` integer not null,
+    `name` text not null,
+    `image` text not null,
+    `created_at` real not null,
+    primary key (`id`)
+);
+
+create unique index `idx_email` on users (`email`);
+create index `idx_users_created_at` on users (`created_at`);
+
+create table blogs (
+    `id` text not null,
+    `user_id` text not null,
+    `user_name` text not null,
+    `user_image` text not null,
+    `name` text not null,
+    `summary` text not null,
+    `content` text not null,
+    `created_at` real not null,
+    primary key (`id`)
+);
+
+create index `idx_blogs_created_at` on blogs (`created_at`);
+
+create table comments (
+    `id` text not null,
+    `blog_id` text not null,
+    `user_id` text not null,
+    `user_name` text not null,
+    `user_image` text not null,
+    `content` text not null,
+    `created_at` real not null,
+    primary key (`id`)
+);
+
+create index `idx_comments_created_at` on comments (`created_at`);
+create index `idx_comments_blog_id_created_at` on comments (`blog_id`, `created_at`);
+
+-- email / password:
+-- admin@example.com / password
+
+insert into users (`id`, `email`, `password`, `admin`, `name`, `image`, `created_at`) values ('0010018336417540987fff4508f43fbaed718e263442526000', 'admin@example.com', '5f4dcc3b5aa765d61d8327deb882cf99', 1, 'Administrator', '', 1402909113.628);
@@ -9,6 +9,8 @@ import functools
 import json
 import logging
 from transwarp.web import ctx
+from transwarp.db import Row, DeadlineExceededError
+from transwarp.orm import CompactModel
 
 __author__ = 'Jonathan Zhou'
 
@@ -18,19 +20,40 @@ class Page(object):
     Page object for display web pages.
     """
 
-    def __init__(self, item_count, page_index=1, page_size=15):
+    def __init__(self, item_count, page_index=1, page_size=15, next_cursor=None, previous_cursor=None):
         """
         Init pagination.
-        :param item_count: 
-        :param page_index: 
+        :param item_count: may be an orm.Count estimate, shown as "about N"
+        :param page_index: None if the page was found by cursor
         :param page_size: 
+        :param next_cursor: cursor of the next page, see Model.find_page()
+        :param previous_cursor: cursor of the previous page
         >>> p1 = Page(100,1)
         >>> p1.page_count
         7
+        >>> p2 = Page(100, None, next_cursor='WzEuNSwgImI0MiJd')
+        >>> p2.page_index, p2.has_next, p2.has_previous
+        (None, True, False)
+        >>> from transwarp.orm import Count
+        >>> p3 = Page(Count(1000, approximate=True), 2)
+        >>> p3.approximate, p3.page_count, str(p3)[:24]
+        (True, 67, 'item_count: about 1000, ')
+        >>> json.loads(dumps(p3))['item_count']
+        1000
         """
         self.item_count = item_count
+        self.approximate = getattr(item_count, 'approximate', False)
         self.page_size = page_size
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        if page_index is None:
+            self.page_index = None
+            self.offset = 0
+            self.limit = self.page_size
+            self.has_next = next_cursor is not None
+            self.has_previous = previous_cursor is not None
+            return
         if (item_count == 0) or (page_index < 1) or (page_index > self.page_count):
             self.offset = 0
             self.limit = 0
@@ -44,7 +67,7 @@ class Page(object):
 
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (
-            self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
+            ('about %d' if self.approximate else '%d') % self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
 
@@ -55,9 +78,14 @@ def _dump(obj):
             'page_index': obj.page_index,
             'page_count': obj.page_count,
             'item_count': obj.item_count,
+            'approximate': obj.approximate,
             'has_next': obj.has_next,
-            'has_previous': obj.has_previous
+            'has_previous': obj.has_previous,
+            'next_cursor': obj.next_cursor,
+            'previous_cursor': obj.previous_cursor
         }
+    if isinstance(obj, (Row, CompactModel)):
+        return dict(obj.iteritems())
     raise TypeError('%s is not JSON serializable' % obj)
 
 
@@ -117,6 +145,9 @@ def api(func):
             r = dumps(func(*args, **kw))
         except APIError, e:
             r = json.dumps(dict(error=e.error, data=e.data, message=e.message))
+        except DeadlineExceededError, e:
+            logging.warning('api %s: %s' % (func.__name__, e))
+            r = json.dumps(dict(error='timeout', data='', message=e.message))
         except Exception, e:
             logging.exception(e)
             r = json.dumps(dict(error='internal error', data=e.__class__.__name__, message=e.message))
@@ -9,12 +9,26 @@ Default configurations.
 
 configs = {
     'db': {
+        # 'mysql', or 'sqlite' to use the embedded database file at 'path':
+        'driver': 'mysql',
+        'path': None,
         # 'host': '127.0.0.1',
         'host': '192.168.1.105',
         'port': 3306,
         'user': 'root',
         'password': 'password',
-        'database': 'awesome'
+        'database': 'awesome',
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'recycle': 3600,
+        'warmup': 2,
+        'keepalive': 300
+    },
+    'web': {
+        # seconds a request may take, None for no limit. routes override it with @timeout,
+        # and the proxy may shorten it with the X-Request-Timeout header:
+        'request_timeout': 10
     },
     'session': {
         'secret': 'AwEsOmE'
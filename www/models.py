@@ -6,7 +6,7 @@ Models for 'user' / 'blog' / 'comment'
 import time
 import uuid
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, CompactModel, StringField, BooleanField, FloatField, TextField, ForeignKey, HasMany
 
 
 # TODO STILL NEEDS TESTING AND BUG FIXED / DAY4
@@ -15,37 +15,46 @@ def next_id():
 
 
 class User(Model):
-    __table__ = 'user'
+    __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updateable=False, ddl="varchar(50)")
+    email = StringField(updatable=False, ddl="varchar(50)", unique=True)
     password = StringField(ddl='varchar(50)')
-    admin = BooleanField
+    admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(updateable=False, default=time.time)
+    created_at = FloatField(updatable=False, default=time.time, index=True)
 
 
 class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(updateable=False, ddl='varchar(50)')
+    user_id = StringField(updatable=False, ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(updateable=False, default=time.time)
+    created_at = FloatField(updatable=False, default=time.time, index=True)
 
+    user = ForeignKey('User', 'user_id')
+    comments = HasMany('Comment', 'blog_id', order_by='created_at desc')
 
-class Comment(Model):
-    __table__ = 'comment'
+
+# blogs list up to 1000 comments per page, keep them small:
+class Comment(CompactModel):
+    __table__ = 'comments'
+    # a blog lists its comments newest first:
+    __indexes__ = [('blog_id', 'created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(updateable=False, ddl='varchar(50)')
-    user_id = StringField(updateable=False, ddl='varchar(50)')
+    blog_id = StringField(updatable=False, ddl='varchar(50)')
+    user_id = StringField(updatable=False, ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(updateable=False, default=time.time)
+    created_at = FloatField(updatable=False, default=time.time, index=True)
+
+    blog = ForeignKey('Blog', 'blog_id')
+    user = ForeignKey('User', 'user_id')
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the models with the configured database and print the statements
+that create the missing tables, columns and indexes:
+
+    python schema_sync.py           # print only
+    python schema_sync.py --apply   # print and execute
+"""
+
+__author__ = 'Jonathan Zhou'
+
+import sys
+import logging
+
+logging.basicConfig(level=logging.WARNING)
+
+from transwarp import db, orm
+from models import User, Blog, Comment
+from config import configs
+
+
+def main(apply=False):
+    db.create_engine(**configs.db)
+    n = 0
+    for model in (User, Blog, Comment):
+        for sql in orm.schema_diff(model):
+            print sql
+            if apply:
+                db.update(sql)
+            n = n + 1
+    print '-- %d statement(s) %s.' % (n, 'applied' if apply else 'to apply')
+
+
+if __name__ == '__main__':
+    main('--apply' in sys.argv[1:])
@@ -7,7 +7,7 @@ Database operation module.
 """
 __author__ = 'Jonathan Zhou'
 
-import time, uuid, functools, threading, logging
+import re, sys, json, math, time, uuid, random, functools, threading, logging, collections, itertools
 
 
 # Dict object:
@@ -58,6 +58,116 @@ class Dict(dict):
         self[key] = value
 
 
+class _Columns(dict):
+    '''
+    Column index of a cursor description: maps column name to position and
+    keeps the names in order. Shared by all rows of one result.
+    '''
+    __slots__ = ('names',)
+
+    def __init__(self, names):
+        super(_Columns, self).__init__(itertools.izip(names, itertools.count()))
+        self.names = tuple(names)
+
+
+class Row(object):
+    '''
+    Read-only result row that stores values in a tuple and shares the column
+    index with the other rows of the same result. Support access as x.y and
+    x['y'] style.
+
+    >>> cols = _Columns(('id', 'name'))
+    >>> r = Row(cols, (1, 'Bob'))
+    >>> r.name
+    'Bob'
+    >>> r['id']
+    1
+    >>> r.keys(), r.values(), len(r), 'id' in r
+    (['id', 'name'], [1, 'Bob'], 2, True)
+    >>> dict(r) == dict(id=1, name='Bob')
+    True
+    >>> r
+    {'id': 1, 'name': 'Bob'}
+    >>> r.email
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'Row' object has no attribute 'email'
+    >>> r.name = 'Alice'
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'Row' object is read-only
+    '''
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        _set_columns(self, columns)
+        _set_values(self, tuple(values))
+
+    def __getattr__(self, key):
+        try:
+            return self._values[self._columns[key]]
+        except KeyError:
+            raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(r"'Row' object is read-only")
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key]]
+
+    def get(self, key, default=None):
+        i = self._columns.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._columns.names)
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self._columns.names)
+
+    def values(self):
+        return list(self._values)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def items(self):
+        return zip(self._columns.names, self._values)
+
+    def iteritems(self):
+        return itertools.izip(self._columns.names, self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self._columns.names == other._columns.names and self._values == other._values
+        if isinstance(other, dict):
+            return dict(self.iteritems()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        return r if r is NotImplemented else not r
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{%s}' % ', '.join(['%r: %r' % (k, v) for k, v in self.iteritems()])
+
+
+_set_columns = Row._columns.__set__
+_set_values = Row._values.__set__
+
+
 def next_id(t=None):
     '''
     Return next id as 50-char string.
@@ -70,12 +180,206 @@ def next_id(t=None):
     return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
 
-def _profiling(start, sql=''):
-    t = time.time() - start
-    if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
-    else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+_RE_FP_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_FP_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_FP_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_FP_ROWS = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+_RE_FP_SPACE = re.compile(r'\s+')
+
+
+def _fingerprint(sql):
+    '''
+    Normalize SQL so that statements differing only in literals, IN-list
+    length or number of inserted rows share one fingerprint.
+
+    >>> _fingerprint("SELECT * from  blogs where id='abc' limit 0, 10")
+    'select * from blogs where id=? limit ?, ?'
+    >>> _fingerprint('select * from t1 where id in (?,?,?)')
+    'select * from t1 where id in (?+)'
+    >>> _fingerprint('insert into `user` (`id`,`name`) values (?,?),(?,?)')
+    'insert into `user` (`id`,`name`) values (?+)...'
+    '''
+    sql = _RE_FP_STRING.sub('?', sql)
+    sql = _RE_FP_NUMBER.sub('?', sql)
+    sql = _RE_FP_LIST.sub('(?+)', sql)
+    sql = _RE_FP_ROWS.sub('(?+)...', sql)
+    return _RE_FP_SPACE.sub(' ', sql).strip().lower()
+
+
+class _QueryStats(object):
+    '''
+    Per-fingerprint statement statistics: calls, rows, errors, total time
+    and latency percentiles estimated from a bounded reservoir of samples.
+
+    >>> qs = _QueryStats(samples=200)
+    >>> for n in range(1, 101):
+    ...     qs.record('select ?', n / 1000.0, rows=1)
+    >>> qs.record('select ?', 1.0, error=True)
+    >>> s = qs.stats()[0]
+    >>> s.calls, s.rows, s.errors, s.p50, s.p99
+    (101, 100, 1, 51.0, 100.0)
+    '''
+
+    def __init__(self, samples=1000):
+        self.enabled = True
+        self.samples = samples
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.since = time.time()
+
+    def record(self, fingerprint, elapsed, rows=0, error=False, retries=0):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                entry = self._entries[fingerprint] = Dict(calls=0, rows=0, errors=0, retries=0, total=0.0, max=0.0,
+                                                          samples=[])
+            entry.calls = entry.calls + 1
+            entry.rows = entry.rows + rows
+            entry.retries = entry.retries + retries
+            entry.total = entry.total + elapsed
+            if error:
+                entry.errors = entry.errors + 1
+            if elapsed > entry.max:
+                entry.max = elapsed
+            samples = entry.samples
+            if len(samples) < self.samples:
+                samples.append(elapsed)
+            else:
+                i = random.randint(0, entry.calls - 1)
+                if i < self.samples:
+                    samples[i] = elapsed
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self.since = time.time()
+
+    def stats(self):
+        '''
+        Return list of Dict ordered by total time desc. Times are in milliseconds.
+        '''
+        with self._lock:
+            entries = [(k, Dict(v.keys(), v.values()), sorted(v.samples)) for k, v in self._entries.iteritems()]
+        L = []
+        for fingerprint, e, samples in entries:
+            pct = lambda p: round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+            L.append(Dict(fingerprint=fingerprint, calls=e.calls, rows=e.rows, errors=e.errors, retries=e.retries,
+                          total=round(e.total * 1000, 3), avg=round(e.total * 1000 / e.calls, 3),
+                          p50=pct(0.50), p95=pct(0.95), p99=pct(0.99), max=round(e.max * 1000, 3)))
+        L.sort(key=lambda x: x.total, reverse=True)
+        return L
+
+    def dumps(self, format='json'):
+        '''
+        Return statistics as JSON or as a plain text table.
+        '''
+        L = self.stats()
+        if format == 'json':
+            return json.dumps(dict(since=self.since, statements=L))
+        lines = ['%8s %12s %10s %10s %10s %10s %10s %6s %7s  %s' % (
+            'calls', 'total(ms)', 'avg', 'p50', 'p95', 'p99', 'rows', 'errors', 'retries', 'statement')]
+        for x in L:
+            lines.append('%8d %12.3f %10.3f %10.3f %10.3f %10.3f %10d %6d %7d  %s' % (
+                x.calls, x.total, x.avg, x.p50, x.p95, x.p99, x.rows, x.errors, x.retries, x.fingerprint))
+        return '\n'.join(lines)
+
+
+# statement statistics collector:
+_query_stats = _QueryStats()
+
+
+def _redact(arg):
+    '''
+    Hide string arguments of logged statements but keep their type and length.
+
+    >>> [_redact(x) for x in (None, 42, 1.5, 'secret', u'abc')]
+    [None, 42, 1.5, '<str:6>', '<unicode:3>']
+    '''
+    if arg is None or isinstance(arg, (bool, int, long, float)):
+        return arg
+    if isinstance(arg, basestring):
+        return '<%s:%d>' % (type(arg).__name__, len(arg))
+    return '<%s>' % type(arg).__name__
+
+
+class _SlowQueryLog(object):
+    '''
+    Ring buffer of selects that ran for threshold seconds or more, with
+    redacted arguments and the EXPLAIN output of the statement. A plan is
+    reused for explain_interval seconds per fingerprint so a burst of slow
+    queries does not run EXPLAIN for each of them.
+    '''
+
+    def __init__(self, threshold=None, size=100, explain_interval=60):
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        self._entries = collections.deque(maxlen=size)
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def capture(self, source, statement, args, elapsed, rows):
+        logging.warning('slow query %.3fs: %s' % (elapsed, statement.sql))
+        now = time.time()
+        with self._lock:
+            plan = self._plans.get(statement.fingerprint)
+        if plan is None or now - plan[0] > self.explain_interval:
+            explained = self._explain(source, statement, args)
+            if explained is None:
+                # not cached, the next slow run of the statement tries again:
+                plan = (now, 'EXPLAIN skipped: no free connection')
+            else:
+                plan = (now, explained)
+                with self._lock:
+                    if len(self._plans) >= 1000:
+                        self._plans.clear()
+                    self._plans[statement.fingerprint] = plan
+        entry = Dict(time=now, sql=statement.raw, args=[_redact(a) for a in args], elapsed=round(elapsed * 1000, 3),
+                     rows=rows, fingerprint=statement.fingerprint, plan=plan[1])
+        with self._lock:
+            self._entries.append(entry)
+
+    def _explain(self, source, statement, args):
+        '''
+        Run EXPLAIN for statement on a side connection of source engine. The
+        request that ran the query waits for it, so return None at once if
+        the pool has no connection to spare.
+        '''
+        connection = None
+        cursor = None
+        try:
+            try:
+                connection = source.checkout(dedicated=True, timeout=0)
+            except PoolTimeoutError:
+                return None
+            cursor = connection.cursor()
+            cursor.execute(source.explain + ' ' + statement.sql, args)
+            names = [x[0] for x in cursor.description]
+            return [dict(zip(names, x)) for x in cursor.fetchall()]
+        except Exception, e:
+            logging.warning('explain failed: %s' % e)
+            return 'EXPLAIN failed: %s' % e
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                source.checkin(connection)
+
+    def entries(self):
+        with self._lock:
+            L = list(self._entries)
+        L.reverse()
+        return L
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plans.clear()
+
+
+# slow query log, disabled by default:
+_slow_queries = _SlowQueryLog()
 
 
 class DBError(Exception):
@@ -86,29 +390,339 @@ class MultiColumnsError(DBError):
     pass
 
 
+class PoolTimeoutError(DBError):
+    pass
+
+
+class DeadlineExceededError(DBError):
+    pass
+
+
+class RetryPolicy(object):
+    '''
+    Policy to re-run a transaction that failed on lock contention. Attempt n
+    waits backoff * 2 ** (n - 1) seconds, at most max_backoff, less a random
+    part of up to jitter of it. Errors are retryable if their errno, or a
+    substring of their message, is in codes: by default MySQL deadlock (1213)
+    and lock wait timeout (1205), and SQLite 'database is locked'.
+
+    >>> p = RetryPolicy(max_attempts=3, backoff=0.1, max_backoff=0.3, jitter=0)
+    >>> p.delay(1), p.delay(2), p.delay(3)
+    (0.1, 0.2, 0.3)
+    >>> class E(Exception):
+    ...     errno = 1213
+    >>> p.retryable(E('Deadlock found')), p.retryable(ValueError('database is locked'))
+    (True, True)
+    >>> p.retryable(ValueError('syntax error'))
+    False
+    '''
+
+    def __init__(self, max_attempts=3, backoff=0.05, max_backoff=1.0, jitter=0.5,
+                 codes=(1213, 1205, 'database is locked')):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.codes = codes
+
+    def retryable(self, e):
+        if isinstance(e, DeadlineExceededError):
+            return False
+        if getattr(e, 'errno', None) in self.codes:
+            return True
+        message = str(e)
+        return any(isinstance(c, basestring) and c in message for c in self.codes)
+
+    def delay(self, attempt):
+        '''
+        Return seconds to wait after the failed attempt (counted from 1).
+        '''
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+_RE_WRITE_TABLE = re.compile(
+    r'^\s*(?:(?:insert|replace)(?:\s+ignore)?\s+into|update(?:\s+ignore)?|delete\s+from)\s+`?(\w+)`?', re.I)
+# names after a comma are included too, to catch 'from a, b': extra names only cost index entries.
+_RE_READ_TABLE = re.compile(r'(?:\bfrom\s|\bjoin\s|,)\s*`?(\w+)`?', re.I)
+_RE_SELECT = re.compile(r'^\s*select\b', re.I)
+
+# longest statement or lock wait limit in seconds, whatever the deadline:
+_MAX_BOUND = 3600.0
+
+
+def _bound_seconds(remaining):
+    if not remaining < _MAX_BOUND:
+        remaining = _MAX_BOUND
+    return max(1, int(math.ceil(remaining)))
+
+
+def _parse_tables(sql):
+    '''
+    Return tables written by an insert/update/delete statement, or tables
+    read by a select statement, as frozenset. Return None if unknown.
+
+    >>> sorted(_parse_tables('select * from blogs where id=?'))
+    ['blogs']
+    >>> sorted(_parse_tables('select b.* from `blogs` b join comments c on c.blog_id=b.id, users u where 1'))
+    ['blogs', 'comments', 'users']
+    >>> sorted(_parse_tables('select count(id) from (select id from blogs) t'))
+    ['blogs']
+    >>> sorted(_parse_tables('insert into `comments` (`id`) values (?)'))
+    ['comments']
+    >>> sorted(_parse_tables('update users set name=? where id=?'))
+    ['users']
+    >>> sorted(_parse_tables('delete from blogs where id=?'))
+    ['blogs']
+    >>> _parse_tables('drop table blogs') is None
+    True
+    '''
+    m = _RE_WRITE_TABLE.match(sql)
+    if m:
+        return frozenset([m.group(1).lower()])
+    if not sql.lstrip()[:6].lower() == 'select':
+        return None
+    return frozenset([t.lower() for t in _RE_READ_TABLE.findall(sql)])
+
+
+class _Statement(object):
+    '''
+    Compiled SQL statement: the original SQL with '?' placeholders translated
+    to the driver's paramstyle, the tables it reads or writes and its
+    fingerprint for statistics.
+    '''
+
+    def __init__(self, sql, paramstyle='format'):
+        self.raw = sql
+        self.sql = sql.replace('?', '%s') if paramstyle == 'format' else sql
+        self.tables = _parse_tables(sql)
+        self.fingerprint = _fingerprint(sql)
+        self.op = (sql.split(None, 1) or [''])[0].lower()
+
+
+class _StatementCache(object):
+    '''
+    LRU cache of compiled statements keyed by the original SQL text.
+
+    >>> c = _StatementCache(2)
+    >>> c.get('select * from user where id=?').sql
+    'select * from user where id=%s'
+    >>> s = c.get('select * from user where id=?')
+    >>> s = c.get('select count(*) from user')
+    >>> s = c.get('select * from blogs where id=?')
+    >>> c.stats().hits, c.stats().misses, c.stats().evictions, c.stats().size
+    (1, 3, 1, 2)
+    '''
+
+    def __init__(self, capacity=256, paramstyle='format'):
+        self.capacity = capacity
+        self.paramstyle = paramstyle
+        self._statements = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sql):
+        with self._lock:
+            statement = self._statements.pop(sql, None)
+            if statement is None:
+                self.misses = self.misses + 1
+                statement = _Statement(sql, self.paramstyle)
+                if len(self._statements) >= self.capacity:
+                    self._statements.popitem(last=False)
+                    self.evictions = self.evictions + 1
+            else:
+                self.hits = self.hits + 1
+            self._statements[sql] = statement
+            return statement
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return Dict(capacity=self.capacity, size=len(self._statements), hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
+
+
+# compiled statements shared by all connections:
+_statements = _StatementCache()
+
+
+def _sizeof(obj):
+    '''
+    Return approximate memory used by a query result.
+    '''
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum([_sizeof(x) for x in obj])
+    if isinstance(obj, Row):
+        return sys.getsizeof(obj) + _sizeof(obj._values)
+    return sys.getsizeof(obj)
+
+
+class _QueryCache(object):
+    '''
+    LRU cache of select results with TTL, indexed by the tables each query
+    reads so that a write to a table drops every cached result that read it.
+    A capacity of 0 disables the cache.
+
+    >>> c = _QueryCache(2, 60)
+    >>> c.put('k1', frozenset(['blogs']), [1], c.generations(frozenset(['blogs'])))
+    >>> c.get('k1')
+    [1]
+    >>> c.invalidate(frozenset(['blogs']))
+    >>> c.get('k1') is _MISS
+    True
+    >>> c.stats().hits, c.stats().misses, c.stats().invalidations
+    (1, 1, 1)
+    '''
+
+    def __init__(self, capacity=0, ttl=60):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._tables = {}
+        self._generations = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generations(self, tables):
+        '''
+        Return a snapshot of the write generation of tables, taken before a
+        query runs so that its result is not cached if a write raced it.
+        '''
+        with self._lock:
+            return tuple([self._generations[t] for t in tables])
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses = self.misses + 1
+                return _MISS
+            if entry[0] < time.time():
+                self._remove(key, entry)
+                self.misses = self.misses + 1
+                return _MISS
+            self._entries[key] = entry
+            self.hits = self.hits + 1
+            return entry[2]
+
+    def put(self, key, tables, value, generations, ttl=None):
+        size = _sizeof(value)
+        with self._lock:
+            if generations != tuple([self._generations[t] for t in tables]):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._remove(key, old)
+            while len(self._entries) >= self.capacity:
+                k, entry = self._entries.popitem(last=False)
+                self._remove(k, entry)
+                self.evictions = self.evictions + 1
+            self._entries[key] = (time.time() + (self.ttl if ttl is None else min(ttl, self.ttl)), tables, value, size)
+            self.bytes = self.bytes + size
+            for t in tables:
+                self._tables.setdefault(t, set()).add(key)
+
+    def _remove(self, key, entry):
+        self._entries.pop(key, None)
+        self.bytes = self.bytes - entry[3]
+        for t in entry[1]:
+            keys = self._tables.get(t)
+            if keys is not None:
+                keys.discard(key)
+
+    def invalidate(self, tables):
+        '''
+        Drop cached results that read any of tables, or everything if tables is None.
+        '''
+        with self._lock:
+            if tables is None:
+                self._entries.clear()
+                self._tables.clear()
+                self.bytes = 0
+                for t in self._generations:
+                    self._generations[t] = self._generations[t] + 1
+                self.invalidations = self.invalidations + 1
+                return
+            for t in tables:
+                self._generations[t] = self._generations[t] + 1
+                for key in list(self._tables.pop(t, ())):
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        self._remove(key, entry)
+            self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        self.invalidate(None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return Dict(capacity=self.capacity, ttl=self.ttl, size=len(self._entries), bytes=self.bytes,
+                        hits=self.hits, misses=self.misses, hit_rate=float(self.hits) / total if total else 0.0,
+                        evictions=self.evictions, invalidations=self.invalidations)
+
+
+# marker of a query cache miss:
+_MISS = object()
+
+# select result cache, disabled by default:
+_query_cache = _QueryCache()
+
+
 class _LasyConnection(object):
-    def __init__(self):
+    def __init__(self, read=False):
+        self.read = read
+        self.engine = None
         self.connection = None
 
-    def cursor(self):
+    def cursor(self, statement=None):
+        '''
+        Return cursor, or the cached prepared cursor of statement if the
+        engine uses server-side prepared statements.
+        '''
         if self.connection is None:
-            connection = engine.connect()
+            self.engine = engine.reader() if self.read else engine
+            try:
+                connection = self.engine.checkout()
+            except Exception, e:
+                if self.engine is engine:
+                    raise
+                logging.warning('replica unavailable, read from primary: %s' % e)
+                self.engine = engine
+                connection = engine.checkout()
             logging.info('open connection <%s>...' % hex(id(connection)))
             self.connection = connection
+        if statement is not None and self.engine.prepared:
+            return self.connection.prepared_cursor(statement, _statements.capacity)
         return self.connection.cursor()
 
+    def release(self, cursor, statement=None, error=False):
+        self.connection.release(cursor, statement, error)
+
     def commit(self):
-        self.connection.commit()
+        if self.connection:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
 
     def cleanup(self):
         if self.connection:
             connection = self.connection
             self.connection = None
-            logging.info('close connection <%s>...' % hex(id(connection)))
-            connection.close()
+            logging.info('release connection <%s>...' % hex(id(connection)))
+            self.engine.checkin(connection)
 
 
 class _DbCtx(threading.local):
@@ -118,7 +732,12 @@ class _DbCtx(threading.local):
 
     def __init__(self):
         self.connection = None
+        self.replica = None
         self.transactions = 0
+        self.last_write = 0.0
+        self.written = set()
+        self.batch = None
+        self.deadline = None
 
     def is_init(self):
         return not self.connection is None
@@ -126,11 +745,16 @@ class _DbCtx(threading.local):
     def init(self):
         logging.info('open lazy connection...')
         self.connection = _LasyConnection()
+        self.replica = _LasyConnection(read=True)
         self.transactions = 0
 
     def cleanup(self):
-        self.connection.cleanup()
-        self.connection = None
+        try:
+            self.replica.cleanup()
+        finally:
+            self.replica = None
+            self.connection.cleanup()
+            self.connection = None
 
     def cursor(self):
         '''
@@ -138,6 +762,20 @@ class _DbCtx(threading.local):
         '''
         return self.connection.cursor()
 
+    def use_replica(self):
+        '''
+        Return True if reads can go to a replica: outside any transaction and
+        not within the read-your-writes window after a write on this thread.
+        '''
+        return bool(engine.replicas) and self.transactions == 0 and \
+               time.time() - self.last_write >= engine.read_your_writes
+
+    def reader(self):
+        '''
+        Return the lazy connection that serves reads.
+        '''
+        return self.replica if self.use_replica() else self.connection
+
 
 # thread-local db context:
 _db_ctx = _DbCtx()
@@ -146,28 +784,786 @@ _db_ctx = _DbCtx()
 engine = None
 
 
+class _Connection(object):
+    '''
+    Wraps a DB-API connection with the bookkeeping the engine needs.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.prepared = collections.OrderedDict()
+        # lock wait timeout and select time limit set by a deadline, None for the server defaults:
+        self.lock_wait_timeout = None
+        self.max_execution_time = None
+
+    def cursor(self, buffered=None):
+        if buffered is None:
+            return self.connection.cursor()
+        return self.connection.cursor(buffered=buffered)
+
+    def prepared_cursor(self, statement, capacity):
+        '''
+        Return the prepared cursor of statement, keeping at most capacity
+        prepared statements open on this connection.
+        '''
+        cursor = self.prepared.pop(statement.raw, None)
+        if cursor is None:
+            cursor = self.connection.cursor(prepared=True, buffered=False)
+            if len(self.prepared) >= capacity:
+                self.prepared.popitem(last=False)[1].close()
+        self.prepared[statement.raw] = cursor
+        return cursor
+
+    def release(self, cursor, statement=None, error=False):
+        '''
+        Close cursor unless it is a cached prepared cursor that is still usable.
+        '''
+        if statement is not None and self.prepared.get(statement.raw) is cursor:
+            if not error:
+                return
+            del self.prepared[statement.raw]
+        cursor.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        for cursor in self.prepared.itervalues():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        self.prepared.clear()
+        self.connection.close()
+
+    def ping(self):
+        '''
+        Return True if the underlying connection is still usable.
+        '''
+        try:
+            ping = getattr(self.connection, 'ping', None)
+            if ping is not None:
+                ping()
+            else:
+                cursor = self.connection.cursor()
+                try:
+                    cursor.execute('select 1')
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+            return True
+        except Exception, e:
+            logging.warning('ping connection <%s> failed: %s' % (hex(id(self)), e))
+            return False
+
+
 class _Engine(object):
-    def __init__(self, connect):
+    '''
+    Engine that opens a new connection on checkout and closes it on checkin.
+    '''
+
+    dialect = 'mysql'
+    paramstyle = 'format'
+    explain = 'explain'
+    # max number of '?' placeholders in one statement:
+    max_params = 65535
+
+    def __init__(self, connect, prepared=False):
         self._connect = connect
+        self.prepared = prepared
+        self.replicas = []
+        self.replica_strategy = 'round_robin'
+        self.read_your_writes = 0
+        self._next_replica = itertools.count()
+        self._in_use = 0
 
     def connect(self):
         return self._connect()
 
+    def checkout(self, dedicated=False, timeout=None):
+        '''
+        Return a connection. A dedicated connection is not shared with the
+        connection contexts of the current thread. A pool waits at most
+        timeout seconds, pool_timeout by default, for a free connection.
+        '''
+        connection = _Connection(self.connect())
+        self._in_use = self._in_use + 1
+        return connection
+
+    def checkin(self, connection, invalidate=False):
+        self._in_use = self._in_use - 1
+        connection.close()
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
-    import mysql.connector
+    def load(self):
+        '''
+        Return number of connections currently checked out.
+        '''
+        return self._in_use
+
+    def reader(self):
+        '''
+        Return the replica engine that should serve the next read, or self if
+        no replica is configured.
+        '''
+        if not self.replicas:
+            return self
+        if self.replica_strategy == 'least_load':
+            return min(self.replicas, key=lambda e: e.load())
+        return self.replicas[self._next_replica.next() % len(self.replicas)]
+
+    def stats(self):
+        return Dict(pool_size=0, max_overflow=0, size=self._in_use, in_use=self._in_use, idle=0, waits=0,
+                    wait_time=0.0)
+
+    def warmup(self, n):
+        '''
+        Pre-open n connections. Return seconds spent.
+        '''
+        return 0.0
+
+    def start_keepalive(self, interval):
+        pass
+
+    def dispose(self):
+        pass
+
+    def bound(self, connection, statement, remaining):
+        '''
+        Return the SQL to execute statement on connection within remaining
+        seconds: a select carries a MAX_EXECUTION_TIME hint, and a write
+        waits for row locks no longer than the remaining time.
+        '''
+        if not remaining < _MAX_BOUND:
+            remaining = _MAX_BOUND
+        if statement.op == 'select':
+            hint = ' /*+ MAX_EXECUTION_TIME(%d) */' % max(1, int(remaining * 1000))
+            return _RE_SELECT.sub(lambda m: m.group(0) + hint, statement.sql, 1)
+        self.limit_lock_wait(connection, remaining)
+        return statement.sql
+
+    def bound_session(self, connection, statement, remaining):
+        '''
+        Limit statement on connection to remaining seconds with session
+        variables and leave its SQL unchanged, so that a cached prepared
+        cursor can run it. Limits are whole seconds and only ever lowered
+        until the connection is checked in, so a request changes them at
+        most once a second.
+        '''
+        if statement.op == 'select':
+            self.limit_execution_time(connection, remaining)
+        else:
+            self.limit_lock_wait(connection, remaining)
+
+    def limit_lock_wait(self, connection, remaining):
+        seconds = _bound_seconds(remaining)
+        if connection.lock_wait_timeout is None or seconds < connection.lock_wait_timeout:
+            self._set_session(connection, 'innodb_lock_wait_timeout', seconds)
+            connection.lock_wait_timeout = seconds
+
+    def limit_execution_time(self, connection, remaining):
+        seconds = _bound_seconds(remaining)
+        if connection.max_execution_time is None or seconds < connection.max_execution_time:
+            self._set_session(connection, 'max_execution_time', seconds * 1000)
+            connection.max_execution_time = seconds
+
+    def reset_limits(self, connection):
+        if connection.lock_wait_timeout is not None:
+            self._set_session(connection, 'innodb_lock_wait_timeout', None)
+            connection.lock_wait_timeout = None
+        if connection.max_execution_time is not None:
+            self._set_session(connection, 'max_execution_time', None)
+            connection.max_execution_time = None
+
+    def _set_session(self, connection, name, value):
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute('set session %s=%s' % (name, 'default' if value is None else value))
+        finally:
+            cursor.close()
+
+    def execute_batch(self, cursor, writes):
+        '''
+        Execute list of (statement, args) as multi-statement queries, each
+        one round-trip, and return the row count of every statement.
+        '''
+        counts = []
+        i = 0
+        while i < len(writes):
+            sqls = []
+            params = []
+            while i < len(writes) and len(sqls) < 500 and (
+                            not sqls or len(params) + len(writes[i][1]) <= self.max_params):
+                statement, args = writes[i]
+                sqls.append(statement.sql)
+                params.extend(args)
+                i = i + 1
+            if len(sqls) == 1:
+                cursor.execute(sqls[0], params)
+                counts.append(cursor.rowcount)
+            else:
+                counts.extend([r.rowcount for r in cursor.execute(';'.join(sqls), params, multi=True)])
+        return counts
+
+
+class _PooledEngine(_Engine):
+    '''
+    Engine that keeps at most pool_size idle connections and allows up to
+    max_overflow extra connections under load. Checkout blocks for at most
+    pool_timeout seconds when the pool is exhausted, and connections older
+    than recycle seconds are reopened on checkout.
+
+    warmup() pre-opens idle connections, and start_keepalive() runs a daemon
+    thread that pings idle connections and replaces the dead or expired ones
+    before a request checks them out.
+    '''
+
+    def __init__(self, connect, pool_size=5, max_overflow=10, pool_timeout=30, recycle=3600, prepared=False):
+        super(_PooledEngine, self).__init__(connect, prepared)
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.recycle = recycle
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._checkouts = 0
+        self._recycled = 0
+        self._invalidated = 0
+        self._warmup_time = 0.0
+        self._pings = 0
+        self._replaced = 0
+        self._keepalive = None
+        self._closed = threading.Event()
+        self._cond = threading.Condition(threading.Lock())
+
+    def _open(self):
+        try:
+            return _Connection(self.connect())
+        except:
+            with self._cond:
+                self._size = self._size - 1
+                self._in_use = self._in_use - 1
+                self._cond.notify()
+            raise
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception, e:
+            logging.warning('close connection <%s> failed: %s' % (hex(id(connection)), e))
+        with self._cond:
+            self._size = self._size - 1
+            self._cond.notify()
+
+    def warmup(self, n):
+        start = time.time()
+        n = min(n, self.pool_size)
+        with self._cond:
+            n = max(0, n - self._size)
+            self._size = self._size + n
+        opened = []
+        try:
+            for i in range(n):
+                opened.append(_Connection(self.connect()))
+        finally:
+            with self._cond:
+                self._size = self._size - (n - len(opened))
+                self._idle.extend(opened)
+                self._cond.notify_all()
+            self._warmup_time = time.time() - start
+        logging.info('warm up %d connections in %.3f seconds.' % (len(opened), self._warmup_time))
+        return self._warmup_time
+
+    def keepalive(self, idle_time):
+        '''
+        Ping connections idle for at least idle_time seconds, and replace the
+        ones that are dead or older than recycle seconds.
+        '''
+        now = time.time()
+        with self._cond:
+            stale = [c for c in self._idle if now - c.last_used >= idle_time]
+            if not stale:
+                return
+            self._idle = [c for c in self._idle if now - c.last_used < idle_time]
+        alive = []
+        for connection in stale:
+            if self.recycle and now - connection.created_at > self.recycle:
+                expired = True
+            else:
+                expired = False
+                self._pings = self._pings + 1
+                if connection.ping():
+                    connection.last_used = time.time()
+                    alive.append(connection)
+                    continue
+            logging.info('keepalive replaces %s connection <%s>...' % (
+                'expired' if expired else 'dead', hex(id(connection))))
+            try:
+                connection.close()
+            except Exception:
+                pass
+            try:
+                alive.append(_Connection(self.connect()))
+                self._replaced = self._replaced + 1
+            except Exception, e:
+                logging.warning('keepalive cannot reopen connection: %s' % e)
+                with self._cond:
+                    self._size = self._size - 1
+        with self._cond:
+            self._idle[0:0] = alive
+            self._cond.notify_all()
+
+    def start_keepalive(self, interval):
+        '''
+        Start a daemon thread that runs keepalive() every interval seconds.
+        '''
+        if self._keepalive is not None:
+            return
+
+        def _run():
+            while not self._closed.wait(interval):
+                try:
+                    self.keepalive(interval)
+                except Exception, e:
+                    logging.exception(e)
+
+        self._keepalive = threading.Thread(target=_run, name='db-keepalive')
+        self._keepalive.daemon = True
+        self._keepalive.start()
+
+    def dispose(self):
+        '''
+        Stop the keepalive thread and close idle connections.
+        '''
+        self._closed.set()
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._size = self._size - len(idle)
+        for connection in idle:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def checkout(self, dedicated=False, timeout=None):
+        if timeout is None:
+            timeout = self.pool_timeout
+        start = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    connection = self._idle.pop()
+                    break
+                if self._size < self.pool_size + self.max_overflow:
+                    connection = None
+                    self._size = self._size + 1
+                    break
+                now = time.time()
+                if start is None:
+                    start = now
+                    self._waits = self._waits + 1
+                remaining = start + timeout - now
+                if remaining <= 0:
+                    self._wait_time = self._wait_time + (now - start)
+                    raise PoolTimeoutError('Pool exhausted: %d connections in use, timeout %ss.' % (
+                        self._in_use, timeout))
+                self._cond.wait(remaining)
+            if start is not None:
+                self._wait_time = self._wait_time + (time.time() - start)
+            self._in_use = self._in_use + 1
+            self._checkouts = self._checkouts + 1
+        if connection is not None:
+            if self.recycle and time.time() - connection.created_at > self.recycle:
+                logging.info('recycle connection <%s>...' % hex(id(connection)))
+                counter = '_recycled'
+            elif connection.ping():
+                return connection
+            else:
+                counter = '_invalidated'
+            with self._cond:
+                setattr(self, counter, getattr(self, counter) + 1)
+            try:
+                connection.close()
+            except Exception:
+                pass
+        return self._open()
+
+    def checkin(self, connection, invalidate=False):
+        if not invalidate:
+            try:
+                # do not leak an open transaction (or a stale snapshot) to the next user:
+                if getattr(connection.connection, 'in_transaction', True):
+                    connection.rollback()
+                self.reset_limits(connection)
+            except Exception, e:
+                logging.warning('reset connection <%s> failed: %s' % (hex(id(connection)), e))
+                invalidate = True
+        with self._cond:
+            self._in_use = self._in_use - 1
+            if not invalidate and len(self._idle) < self.pool_size:
+                connection.last_used = time.time()
+                self._idle.append(connection)
+                self._cond.notify()
+                return
+        self._discard(connection)
+
+    def stats(self):
+        with self._cond:
+            return Dict(pool_size=self.pool_size, max_overflow=self.max_overflow, size=self._size,
+                        in_use=self._in_use, idle=len(self._idle), waits=self._waits, wait_time=self._wait_time,
+                        checkouts=self._checkouts, recycled=self._recycled, invalidated=self._invalidated,
+                        warmup_time=self._warmup_time, pings=self._pings, replaced=self._replaced)
+
+
+class _SQLiteConnection(_Connection):
+    def cursor(self, buffered=None):
+        return self.connection.cursor()
+
+
+class _SQLiteEngine(_Engine):
+    '''
+    Engine of an embedded SQLite database. Each thread reuses one connection,
+    opened in WAL mode so that readers do not block the writer. sqlite3
+    caches prepared statements per connection by itself. Statements still
+    running at the deadline of the thread are interrupted by a progress
+    handler.
+    '''
+
+    dialect = 'sqlite'
+    paramstyle = 'qmark'
+    explain = 'explain query plan'
+    max_params = 999
+
+    def __init__(self, path, cached_statements=256, timeout=5.0):
+        import sqlite3
+
+        def connect():
+            connection = sqlite3.connect(path, timeout=timeout, cached_statements=cached_statements)
+            connection.execute('pragma journal_mode=WAL')
+            connection.execute('pragma synchronous=NORMAL')
+            connection.set_progress_handler(_sqlite_progress, 1000)
+            return connection
+
+        super(_SQLiteEngine, self).__init__(connect)
+        self.path = path
+        self._local = threading.local()
+
+    def bound(self, connection, statement, remaining):
+        # interrupted by the progress handler. the wait for the write lock is bounded by the engine's
+        # timeout: a 'pragma busy_timeout' would commit the open transaction of sqlite3.
+        return statement.sql
+
+    def bound_session(self, connection, statement, remaining):
+        pass
+
+    def limit_lock_wait(self, connection, remaining):
+        pass
+
+    def limit_execution_time(self, connection, remaining):
+        pass
+
+    def reset_limits(self, connection):
+        pass
+
+    def checkout(self, dedicated=False, timeout=None):
+        if dedicated and self.path != ':memory:':
+            connection = _SQLiteConnection(self.connect())
+            connection.dedicated = True
+        else:
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = _SQLiteConnection(self.connect())
+                self._local.depth = 0
+            self._local.depth = self._local.depth + 1
+        self._in_use = self._in_use + 1
+        return connection
+
+    def checkin(self, connection, invalidate=False):
+        self._in_use = self._in_use - 1
+        if getattr(connection, 'dedicated', False):
+            connection.close()
+            return
+        # the thread's connection is shared by nested checkouts, reset it only when the last one is done.
+        # it never goes stale and unread rows die with their cursor, so it is kept even if invalidated:
+        self._local.depth = self._local.depth - 1
+        if self._local.depth == 0:
+            connection.rollback()
+            connection.last_used = time.time()
+
+    def execute_batch(self, cursor, writes):
+        # in-process database, there is no round-trip to save:
+        counts = []
+        for statement, args in writes:
+            cursor.execute(statement.sql, args)
+            counts.append(cursor.rowcount)
+        return counts
+
+
+def _sqlite_progress():
+    # a non-zero return interrupts the running statement:
+    return 1 if _db_ctx.deadline is not None and time.time() >= _db_ctx.deadline else 0
+
+
+def create_engine(user=None, password=None, database=None, host='127.0.0.1', port=3306, driver='mysql', path=None,
+                  pool_size=0, max_overflow=10,
+                  pool_timeout=30, recycle=3600, prepared=False, statement_cache_size=256, replicas=None,
+                  replica_strategy='round_robin', read_your_writes=1.0, query_cache_size=0, query_cache_ttl=60,
+                  query_stats=True, warmup=0, keepalive=0, slow_query_threshold=None, slow_query_log_size=100,
+                  **kw):
+    '''
+    Init the global engine. driver is 'mysql' or 'sqlite'.
+
+    The 'sqlite' driver opens the database file at path (or database) with
+    one connection per thread, and ignores the MySQL-only options below.
+
+    A pooled MySQL engine is created if pool_size > 0,
+    otherwise each connection context opens and closes its own connection.
+    A pooled engine pre-opens warmup connections, and if keepalive > 0 a
+    background thread pings connections idle for keepalive seconds and
+    replaces the dead ones.
+    If prepared is True, each connection keeps server-side prepared cursors
+    for the most recently used statement_cache_size statements. Under a
+    deadline their statements are limited by the max_execution_time and
+    innodb_lock_wait_timeout session variables in whole seconds, instead
+    of the MAX_EXECUTION_TIME hint in milliseconds.
+
+    replicas is a list of host names or dicts of connection params that
+    override the primary's. Reads outside a transaction go to a replica
+    chosen by replica_strategy ('round_robin' or 'least_load'), except for
+    read_your_writes seconds after a write on the same thread.
+
+    If query_cache_size > 0, results of select, select_one and select_int
+    outside transactions are cached for query_cache_ttl seconds, and dropped
+    as soon as a write to a table they read is committed.
+
+    If query_stats is True, call count, rows, errors and latency of each
+    statement fingerprint are collected, see query_stats().
+
+    If slow_query_threshold is set, selects running for at least that many
+    seconds are kept with their EXPLAIN plan in a ring buffer of
+    slow_query_log_size entries, see slow_queries().
+    '''
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized.')
+    if driver == 'sqlite':
+        primary = _SQLiteEngine(path or database, statement_cache_size)
+    elif driver == 'mysql':
+        primary = _create_mysql_engine(user, password, database, host, port, pool_size, max_overflow, pool_timeout,
+                                       recycle, prepared, replicas, replica_strategy, read_your_writes, **kw)
+    else:
+        raise DBError('Unsupported driver: %s' % driver)
+    engine = primary
+    global _statements, _query_cache, _slow_queries
+    _statements = _StatementCache(statement_cache_size, engine.paramstyle)
+    _query_cache = _QueryCache(query_cache_size, query_cache_ttl)
+    _slow_queries = _SlowQueryLog(slow_query_threshold, slow_query_log_size)
+    _query_stats.enabled = query_stats
+    for e in [engine] + engine.replicas:
+        if warmup:
+            e.warmup(warmup)
+        if keepalive:
+            e.start_keepalive(keepalive)
+    # test connection...
+    logging.info('Init %s engine <%s> ok.' % (driver, hex(id(engine))))
+
+
+def _create_mysql_engine(user, password, database, host, port, pool_size, max_overflow, pool_timeout, recycle,
+                         prepared, replicas, replica_strategy, read_your_writes, **kw):
+    import mysql.connector
     params = dict(user=user, password=password, database=database, host=host, port=port)
     defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
     for k, v in defaults.iteritems():
         params[k] = kw.pop(k, v)
     params.update(kw)
     params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
-    # test connection...
-    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+    if replica_strategy not in ('round_robin', 'least_load'):
+        raise DBError('Invalid replica strategy: %s' % replica_strategy)
+
+    def _new_engine(params):
+        connect = lambda: mysql.connector.connect(**params)
+        if pool_size > 0:
+            return _PooledEngine(connect, pool_size, max_overflow, pool_timeout, recycle, prepared)
+        return _Engine(connect, prepared)
+
+    primary = _new_engine(params)
+    for replica in replicas or []:
+        if isinstance(replica, basestring):
+            replica = dict(host=replica)
+        primary.replicas.append(_new_engine(dict(params, **replica)))
+    primary.replica_strategy = replica_strategy
+    primary.read_your_writes = read_your_writes
+    return primary
+
+
+def pool_stats():
+    '''
+    Return connection pool statistics of the global engine as Dict:
+    size, in_use, idle, waits, wait_time and so on. Statistics of each
+    read replica are listed under 'replicas'.
+    '''
+    stats = engine.stats()
+    stats.replicas = [e.stats() for e in engine.replicas]
+    return stats
+
+
+def statement_cache_stats():
+    '''
+    Return statement cache statistics as Dict: capacity, size, hits, misses and evictions.
+    '''
+    return _statements.stats()
+
+
+def query_cache_stats():
+    '''
+    Return query result cache statistics as Dict: size, bytes, hits, misses,
+    hit_rate, evictions and invalidations.
+    '''
+    return _query_cache.stats()
+
+
+def query_cache_clear():
+    '''
+    Drop all cached query results.
+    '''
+    _query_cache.clear()
+
+
+def query_stats():
+    '''
+    Return statement statistics as list of Dict ordered by total time desc:
+    fingerprint, calls, rows, errors, retries, total, avg, p50, p95, p99 and
+    max, with times in milliseconds. Transactions run by with_transaction
+    are listed as 'transaction module.function'.
+    '''
+    return _query_stats.stats()
+
+
+def dump_query_stats(format='json'):
+    '''
+    Return statement statistics as 'json' or 'text'.
+    '''
+    return _query_stats.dumps(format)
+
+
+def reset_query_stats():
+    _query_stats.reset()
+
+
+def slow_queries():
+    '''
+    Return captured slow selects as list of Dict, newest first: time, sql,
+    args (redacted), elapsed (ms), rows, fingerprint and plan.
+
+    >>> _slow_queries.threshold = 0
+    >>> u = select_one('select * from user where email=?', 'nobody@test.org')
+    >>> q = slow_queries()[0]
+    >>> q.sql, q.args, len(q.plan) > 0
+    ('select * from user where email=?', ['<str:15>'], True)
+    >>> _slow_queries.threshold = None
+    >>> clear_slow_queries()
+    '''
+    return _slow_queries.entries()
+
+
+def clear_slow_queries():
+    _slow_queries.clear()
+
+
+class _DeadlineCtx(object):
+    '''
+    _DeadlineCtx object that bounds the statements executed in it.
+    '''
+
+    def __init__(self, at):
+        self.at = at
+
+    def __enter__(self):
+        self.saved = _db_ctx.deadline
+        if self.at is not None and (self.saved is None or self.at < self.saved):
+            _db_ctx.deadline = self.at
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        _db_ctx.deadline = self.saved
+
+
+def deadline(at):
+    '''
+    Return _DeadlineCtx object that can be used by 'with' statement. Statements
+    executed in it must finish before time at (as returned by time.time()):
+    the remaining time is applied as the statement timeout, and
+    DeadlineExceededError is raised once it is spent. A nested deadline can
+    only shorten the outer one, and None means no limit.
+
+    >>> with deadline(time.time() + 60):
+    ...     with deadline(time.time() + 3600):
+    ...         0 < _remaining() <= 60
+    True
+    >>> with deadline(time.time() - 1):
+    ...     select('select * from user')  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    DeadlineExceededError: Deadline exceeded by ...
+    >>> _remaining() is None
+    True
+    '''
+    return _DeadlineCtx(at)
+
+
+def _remaining():
+    '''
+    Return seconds left before the deadline of the current thread, or None if
+    there is no deadline. Raise DeadlineExceededError if it has passed.
+    '''
+    if _db_ctx.deadline is None:
+        return None
+    remaining = _db_ctx.deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceededError('Deadline exceeded by %.3f seconds.' % -remaining)
+    return remaining
+
+
+def _check_deadline(e):
+    '''
+    Raise DeadlineExceededError instead of e if the deadline of the current
+    thread has passed, e.g. the statement was interrupted by a timeout.
+    '''
+    if _db_ctx.deadline is not None and time.time() >= _db_ctx.deadline and \
+            not isinstance(e, DeadlineExceededError):
+        raise DeadlineExceededError('Deadline exceeded: %s' % e)
+
+
+def _bounded_cursor(connection, statement):
+    '''
+    Return cursor of the lazy connection and the SQL to execute statement
+    within the deadline of the current thread.
+    '''
+    remaining = _remaining()
+    if remaining is None:
+        return connection.cursor(statement), statement.sql
+    cursor = connection.cursor(statement)
+    if connection.engine.prepared:
+        # a prepared cursor runs the statement as prepared, the limit goes to the session instead of a hint:
+        try:
+            connection.engine.bound_session(connection.connection, statement, remaining)
+        except:
+            connection.release(cursor, statement, True)
+            raise
+        return cursor, statement.sql
+    try:
+        return cursor, connection.engine.bound(connection.connection, statement, remaining)
+    except:
+        cursor.close()
+        raise
 
 
 class _ConnectionCtx(object):
@@ -224,6 +1620,99 @@ def with_connection(func):
     return _wrapper
 
 
+class DeferredResult(object):
+    '''
+    Row count of a write queued by transaction(batch_writes=True). Queued
+    writes are flushed at commit, before the next select in the same
+    transaction, or when the value of any of them is needed.
+    '''
+    __slots__ = ('_value', '_error')
+
+    def __init__(self):
+        self._value = None
+        self._error = None
+
+    @property
+    def resolved(self):
+        return self._value is not None
+
+    @property
+    def value(self):
+        if self._value is None and self._error is None:
+            _flush_writes()
+        if self._error is not None:
+            raise DBError('Batched write failed: %s' % self._error)
+        return self._value
+
+    def _resolve(self, value):
+        self._value = value
+
+    def _fail(self, error):
+        self._error = error
+
+    def __int__(self):
+        return self.value
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return self.value + other
+
+    __radd__ = __add__
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    def __repr__(self):
+        if self._value is None:
+            return '<DeferredResult %s>' % ('failed' if self._error is not None else 'pending')
+        return repr(self._value)
+
+
+def _flush_writes():
+    '''
+    Send the writes queued in the current batched transaction.
+    '''
+    pending = _db_ctx.batch
+    if not pending:
+        return
+    _db_ctx.batch = []
+    cursor = None
+    start = time.time()
+    try:
+        remaining = _remaining()
+        cursor = _db_ctx.connection.cursor()
+        if remaining is not None:
+            engine.limit_lock_wait(_db_ctx.connection.connection, remaining)
+        counts = engine.execute_batch(cursor, [(statement, args) for statement, args, r in pending])
+    except Exception, e:
+        for statement, args, r in pending:
+            r._fail(e)
+        _query_stats.record('-- batch of %d writes' % len(pending), time.time() - start, error=True)
+        _check_deadline(e)
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+    elapsed = (time.time() - start) / len(pending)
+    for (statement, args, r), n in zip(pending, counts):
+        r._resolve(n)
+        _query_stats.record(statement.fingerprint, elapsed, max(n, 0))
+
+
+def _discard_writes(error):
+    pending = _db_ctx.batch
+    _db_ctx.batch = None
+    for statement, args, r in pending or ():
+        r._fail(error)
+
+
 class _TransactionCtx(object):
     '''
     _TransactionCtx object that can handle transactions.
@@ -232,6 +1721,33 @@ class _TransactionCtx(object):
         pass
     '''
 
+    def __init__(self, batch_writes=False, retry=None):
+        self.batch_writes = batch_writes
+        self.retry = retry
+        self.attempt = 1
+        self.delay = None
+        self.iterating = False
+
+    def __iter__(self):
+        '''
+        Yield self once per attempt until the transaction is committed, or
+        fails with an error the retry policy does not retry.
+        '''
+        self.attempt = 0
+        self.iterating = True
+        try:
+            while True:
+                if self.delay is not None:
+                    # the connection is released while waiting:
+                    time.sleep(self.delay)
+                    self.delay = None
+                self.attempt = self.attempt + 1
+                yield self
+                if self.delay is None:
+                    return
+        finally:
+            self.iterating = False
+
     def __enter__(self):
         global _db_ctx
         self.should_close_conn = False
@@ -240,6 +1756,10 @@ class _TransactionCtx(object):
             _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transactions = _db_ctx.transactions + 1
+        self.outermost = _db_ctx.transactions == 1
+        if self.outermost:
+            _db_ctx.written.clear()
+            _db_ctx.batch = [] if self.batch_writes else None
         logging.info('begin transaction...' if _db_ctx.transactions == 1 else 'join current transaction...')
         return self
 
@@ -249,39 +1769,93 @@ class _TransactionCtx(object):
         try:
             if _db_ctx.transactions == 0:
                 if exctype is None:
-                    self.commit()
+                    try:
+                        self.commit()
+                    except Exception, e:
+                        # commit() has rolled back:
+                        if self._should_retry(e):
+                            return True
+                        raise
                 else:
                     self.rollback()
+                    return self._should_retry(excvalue)
         finally:
             if self.should_close_conn:
                 _db_ctx.cleanup()
 
+    def _should_retry(self, e):
+        '''
+        Return True to suppress e and run the transaction again, if it is
+        iterated by attempts and the retry policy allows another one.
+        '''
+        retry = self.retry
+        if retry is None or not self.iterating or not self.outermost:
+            return False
+        if self.attempt >= retry.max_attempts or not retry.retryable(e):
+            return False
+        delay = retry.delay(self.attempt)
+        if _db_ctx.deadline is not None and time.time() + delay >= _db_ctx.deadline:
+            return False
+        logging.warning('transaction failed (attempt %d of %d), retry in %.3f seconds: %s' % (
+            self.attempt, retry.max_attempts, delay, e))
+        self.delay = delay
+        return True
+
     def commit(self):
         global _db_ctx
         logging.info('commit transaction...')
         try:
+            _flush_writes()
+            _db_ctx.batch = None
             _db_ctx.connection.commit()
             logging.info('commit ok.')
         except:
             logging.warning('commit failed. try rollback...')
+            _discard_writes('rolled back')
             _db_ctx.connection.rollback()
+            _db_ctx.written.clear()
             logging.warning('rollback ok.')
             raise
+        _invalidate_written()
 
     def rollback(self):
         global _db_ctx
         logging.warning('rollback transaction...')
+        _discard_writes('rolled back')
+        _db_ctx.written.clear()
         _db_ctx.connection.rollback()
         logging.info('rollback ok.')
 
 
-def transaction():
+def _invalidate_written():
+    '''
+    Drop cached results of tables written by the committed transaction.
+    '''
+    written = _db_ctx.written
+    if written:
+        _query_cache.invalidate(None if None in written else written)
+        written.clear()
+
+
+def transaction(batch_writes=False, retry=None):
     '''
     Create a transaction object so can use with statement:
 
     with transaction():
         pass
 
+    With batch_writes=True, update() and insert() only queue their statements
+    and return DeferredResult objects. The queue is sent in as few
+    round-trips as possible at commit, or earlier if a select runs in the
+    transaction or a deferred row count is needed.
+
+    With a RetryPolicy, iterate the transaction to run it again on a fresh
+    transaction when it fails with a retryable error:
+
+    for tx in transaction(retry=RetryPolicy()):
+        with tx:
+            pass
+
     >>> def update_profile(id, name, rollback):
     ...     u = dict(id=id, name=name, email='%s@test.org' % name, passwd=name, last_modified=time.time())
     ...     insert('user', **u)
@@ -299,13 +1873,48 @@ def transaction():
     StandardError: will cause rollback...
     >>> select('select * from user where id=?', 900302)
     []
+    >>> with transaction(batch_writes=True):
+    ...     r1 = insert('user', id=900303, name='Go', email='go@test.org', passwd='go', last_modified=time.time())
+    ...     r2 = update('update user set passwd=? where id=?', 'GO', 900303)
+    ...     r1.resolved
+    False
+    >>> r1.value, r2.value
+    (1, 1)
+    >>> with transaction(batch_writes=True):
+    ...     r3 = update('update user set name=? where id=?', 'Golang', 900303)
+    ...     select_one('select * from user where id=?', 900303).name
+    u'Golang'
+    >>> attempts = []
+    >>> for tx in transaction(retry=RetryPolicy(backoff=0.001)):
+    ...     with tx:
+    ...         attempts.append(tx.attempt)
+    ...         n = update('update user set passwd=? where id=?', 'golang', 900303)
+    ...         if len(attempts) < 3:
+    ...             raise DBError('database is locked')
+    >>> attempts
+    [1, 2, 3]
+    >>> for tx in transaction(retry=RetryPolicy(max_attempts=2, backoff=0.001)):
+    ...     with tx:
+    ...         raise DBError('database is locked')
+    Traceback (most recent call last):
+      ...
+    DBError: database is locked
+    '''
+    return _TransactionCtx(batch_writes, retry)
+
+
+def in_transaction():
+    '''
+    Return True if the current thread is in a transaction.
     '''
-    return _TransactionCtx()
+    return _db_ctx.transactions > 0
 
 
-def with_transaction(func):
+def with_transaction(func=None, retry=None):
     '''
-    A decorator that makes function around transaction.
+    A decorator that makes function around transaction. Use
+    @with_transaction(retry=RetryPolicy()) to run the whole function again
+    on a fresh transaction when it fails with a retryable error.
 
     >>> @with_transaction
     ... def update_profile(id, name, rollback):
@@ -323,14 +1932,34 @@ def with_transaction(func):
     StandardError: will cause rollback...
     >>> select('select * from user where id=?', 9090)
     []
+    >>> @with_transaction(retry=RetryPolicy(backoff=0.001))
+    ... def deadlocked(n):
+    ...     n.append(1)
+    ...     if len(n) < 2:
+    ...         raise DBError('database is locked')
+    ...     return len(n)
+    >>> deadlocked([])
+    2
+    >>> [s.retries for s in query_stats() if s.fingerprint == 'transaction __main__.deadlocked']
+    [1]
     '''
+    if func is None:
+        return functools.partial(with_transaction, retry=retry)
 
     @functools.wraps(func)
     def _wrapper(*args, **kw):
         _start = time.time()
-        with _TransactionCtx():
-            return func(*args, **kw)
-        _profiling(_start)
+        error = True
+        tx = _TransactionCtx(retry=retry)
+        try:
+            for tx in tx:
+                with tx:
+                    r = func(*args, **kw)
+            error = False
+            return r
+        finally:
+            _query_stats.record('transaction %s.%s' % (func.__module__, func.__name__), time.time() - _start,
+                                error=error, retries=tx.attempt - 1)
 
     return _wrapper
 
@@ -338,23 +1967,77 @@ def with_transaction(func):
 def _select(sql, first, *args):
     ' execute select SQL and return unique result or list results.'
     global _db_ctx
+    statement = _statements.get(sql)
+    if _db_ctx.batch:
+        # reads must see the writes queued before them:
+        _flush_writes()
+    replica = _db_ctx.use_replica()
+    # results from a lagging replica may be cached, so a thread that must read
+    # its own writes bypasses the cache:
+    if _query_cache.capacity and _db_ctx.transactions == 0 and statement.tables is not None and \
+            (replica or not engine.replicas):
+        key = (sql, first, args)
+        try:
+            r = _query_cache.get(key)
+        except TypeError:
+            # unhashable args:
+            return _to_rows(first, *_fetch(statement, first, args))
+        if r is _MISS:
+            generations = _query_cache.generations(statement.tables)
+            r = _to_rows(first, *_fetch(statement, first, args))
+            # a replica may still miss writes for about read_your_writes seconds:
+            _query_cache.put(key, statement.tables, r, generations, engine.read_your_writes if replica else None)
+        # rows are read-only but the list is not:
+        return r if first else list(r)
+    return _to_rows(first, *_fetch(statement, first, args))
+
+
+def _to_rows(first, names, rows):
+    columns = _Columns(names)
+    if first:
+        return Row(columns, rows[0]) if rows else None
+    return [Row(columns, x) for x in rows]
+
+
+def _fetch(statement, first, args):
+    '''
+    Execute select statement and return column names and list of rows, which
+    contains at most one row if first is True.
+    '''
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    error = True
+    names = []
+    rows = []
+    logging.info('SQL: %s, ARGS: %s', statement.sql, args)
+    connection = _db_ctx.reader()
+    start = time.time()
     try:
-        cursor = _db_ctx.connection.cursor()
+        cursor, sql = _bounded_cursor(connection, statement)
         cursor.execute(sql, args)
         if cursor.description:
             names = [x[0] for x in cursor.description]
-        if first:
+        if connection.engine.prepared:
+            # prepared cursors are unbuffered and must be drained before reuse:
+            rows = cursor.fetchall()
+            if first:
+                rows = rows[:1]
+        elif first:
             values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            rows = [values] if values else []
+        else:
+            rows = cursor.fetchall()
+        error = False
+        return names, rows
+    except Exception, e:
+        _check_deadline(e)
+        raise
     finally:
         if cursor:
-            cursor.close()
+            connection.release(cursor, statement, error)
+        elapsed = time.time() - start
+        _query_stats.record(statement.fingerprint, elapsed, len(rows), error)
+        if not error and _slow_queries.threshold is not None and elapsed >= _slow_queries.threshold:
+            _slow_queries.capture(connection.engine, statement, args, elapsed, len(rows))
 
 
 @with_connection
@@ -438,24 +2121,114 @@ def select(sql, *args):
     return _select(sql, False, *args)
 
 
+def select_iter(sql, *args, **kw):
+    '''
+    Execute select SQL and return a generator of results. Rows are read by an
+    unbuffered cursor on a dedicated connection, 'batch' rows at a time, so
+    memory use does not depend on the size of the result set, and other
+    statements can be executed while iterating.
+
+    Inside a transaction the dedicated connection could not see the writes
+    of the transaction, so the queued writes are flushed and the rows are
+    read at once on the connection of the transaction instead.
+
+    >>> for n in range(3000, 3005):
+    ...     r = insert('user', id=n, name='Iter%s' % n, email='iter@test.org', passwd='iter', last_modified=time.time())
+    >>> [u.name for u in select_iter('select * from user where email=? order by id', 'iter@test.org', batch=2)]
+    [u'Iter3000', u'Iter3001', u'Iter3002', u'Iter3003', u'Iter3004']
+    >>> it = select_iter('select * from user where email=? order by id', 'iter@test.org', batch=2)
+    >>> it.next().id
+    3000
+    >>> it.close()
+    >>> with transaction():
+    ...     r = insert('user', id=3005, name='Iter3005', email='iter@test.org', passwd='iter', last_modified=time.time())
+    ...     len(list(select_iter('select * from user where email=?', 'iter@test.org')))
+    6
+    '''
+    batch = kw.pop('batch', 1000)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+    if _db_ctx.transactions:
+        for row in _select(sql, False, *args):
+            yield row
+        return
+    statement = _statements.get(sql)
+    logging.info('SQL: %s, ARGS: %s', statement.sql, args)
+    source = engine.reader() if _db_ctx.use_replica() else engine
+    connection = source.checkout(dedicated=True)
+    cursor = None
+    exhausted = False
+    error = True
+    n = 0
+    start = time.time()
+    try:
+        remaining = _remaining()
+        sql = statement.sql if remaining is None else source.bound(connection, statement, remaining)
+        cursor = connection.cursor(buffered=False)
+        cursor.execute(sql, args)
+        columns = _Columns([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            n = n + len(rows)
+            for values in rows:
+                yield Row(columns, values)
+        exhausted = True
+        error = False
+    except GeneratorExit:
+        # closed early by the caller, not a failure of the query:
+        error = False
+        raise
+    except Exception, e:
+        _check_deadline(e)
+        raise
+    finally:
+        try:
+            if cursor:
+                cursor.close()
+        except Exception:
+            exhausted = False
+        # an unbuffered cursor closed early leaves unread rows on the connection:
+        source.checkin(connection, invalidate=not exhausted)
+        _query_stats.record(statement.fingerprint, time.time() - start, n, error)
+
+
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    error = True
+    r = 0
+    statement = _statements.get(sql)
+    logging.info('SQL: %s, ARGS: %s', statement.sql, args)
+    if _db_ctx.batch is not None and _db_ctx.transactions:
+        r = DeferredResult()
+        _db_ctx.batch.append((statement, args, r))
+        _db_ctx.last_write = time.time()
+        _db_ctx.written.update(statement.tables or (None,))
+        return r
+    start = time.time()
     try:
-        cursor = _db_ctx.connection.cursor()
+        cursor, sql = _bounded_cursor(_db_ctx.connection, statement)
         cursor.execute(sql, args)
+        _db_ctx.last_write = time.time()
         r = cursor.rowcount
+        _db_ctx.written.update(statement.tables or (None,))
         if _db_ctx.transactions == 0:
             # no transaction enviroment:
             logging.info('auto commit')
             _db_ctx.connection.commit()
+            _invalidate_written()
+        error = False
         return r
+    except Exception, e:
+        _check_deadline(e)
+        raise
     finally:
         if cursor:
-            cursor.close()
+            _db_ctx.connection.release(cursor, statement, error)
+        _query_stats.record(statement.fingerprint, time.time() - start, max(r, 0), error)
 
 
 def insert(table, **kw):
@@ -468,7 +2241,7 @@ def insert(table, **kw):
     >>> u2 = select_one('select * from user where id=?', 2000)
     >>> u2.name
     u'Bob'
-    >>> insert('user', **u2)
+    >>> insert('user', **u2) # doctest: +IGNORE_EXCEPTION_DETAIL
     Traceback (most recent call last):
       ...
     IntegrityError: 1062 (23000): Duplicate entry '2000' for key 'PRIMARY'
@@ -479,6 +2252,52 @@ def insert(table, **kw):
     return _update(sql, *args)
 
 
+def insert_many(table, rows, chunk_size=500):
+    '''
+    Execute insert SQL for many rows in one transaction. Rows are dicts with
+    the same keys and are sent chunk_size rows per multi-row insert.
+    Return the number of inserted rows.
+
+    >>> rows = [dict(id=n, name='Bulk%s' % n, email='bulk@test.org', passwd='bulk', last_modified=time.time()) for n in range(4000, 4005)]
+    >>> insert_many('user', rows, chunk_size=2)
+    5
+    >>> select_int('select count(*) from user where email=?', 'bulk@test.org')
+    5
+    >>> insert_many('user', [dict(id=4100, name='Ann'), dict(id=4101, email='bob@test.org')])
+    Traceback (most recent call last):
+      ...
+    DBError: All rows must have the same columns.
+    >>> select('select * from user where id=?', 4100)
+    []
+    '''
+    it = iter(rows)
+    first = next(it, None)
+    if first is None:
+        return 0
+    n = 0
+    cols = first.keys()
+    it = itertools.chain([first], it)
+    chunk_size = max(1, min(chunk_size, engine.max_params // len(cols)))
+    with transaction():
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                break
+            args = []
+            try:
+                for row in chunk:
+                    if len(row) != len(cols):
+                        raise KeyError()
+                    args.extend([row[col] for col in cols])
+            except KeyError:
+                raise DBError('All rows must have the same columns.')
+            values = '(%s)' % ','.join(['?' for col in cols])
+            sql = 'insert into `%s` (%s) values %s' % (
+                table, ','.join(['`%s`' % col for col in cols]), ','.join([values for row in chunk]))
+            n = n + _update(sql, *args)
+    return n
+
+
 def update(sql, *args):
     r'''
     Execute update SQL.
@@ -506,7 +2325,10 @@ def update(sql, *args):
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    create_engine('www-data', 'www-data', 'test')
+    if 'sqlite' in sys.argv[1:]:
+        create_engine(driver='sqlite', path=':memory:')
+    else:
+        create_engine('www-data', 'www-data', 'test')
     update('drop table if exists user')
     update('create table user (id int primary key, name text, email text, passwd text, last_modified real)')
     import doctest
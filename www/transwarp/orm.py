@@ -8,7 +8,7 @@ This module is independent with web module.
 """
 
 __author__ = 'Michael Liao'
-import time, logging
+import re, sys, json, time, base64, logging, threading
 
 import db
 
@@ -24,6 +24,8 @@ class Field(object):
         self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl', '')
+        self.index = kw.get('index', False)
+        self.unique = kw.get('unique', False)
         self._order = Field._count
         Field._count = Field._count + 1
 
@@ -100,47 +102,489 @@ class VersionField(Field):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
 
+class _Relation(object):
+    '''
+    Base class of relations between models. A relation is read as an
+    attribute: the related instances are selected when first read, or by
+    find_by(prefetch=[...]) for all instances of a result at once.
+    '''
+
+    def __init__(self, model, column):
+        self.name = None
+        self._model = model
+        self.column = column
+
+    @property
+    def model(self):
+        # resolve a model given by name, which may be defined later:
+        if isinstance(self._model, basestring):
+            self._model = ModelMetaclass.subclasses[self._model]
+        return self._model
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        related = obj._related
+        if related is None or not self.name in related:
+            self.prefetch([obj])
+        return obj._related[self.name]
+
+    def _attach(self, obj, value):
+        if obj._related is None:
+            object.__setattr__(obj, '_related', {})
+        obj._related[self.name] = value
+
+
+class ForeignKey(_Relation):
+    '''
+    The instance of model whose primary key is the value of column, or None.
+
+    class Comment(Model):
+        blog_id = StringField()
+        blog = ForeignKey('Blog', 'blog_id')
+    '''
+
+    def prefetch(self, objs):
+        '''
+        Attach the related instance to each of objs with one get_many().
+        Return the distinct related instances.
+        '''
+        keys = list(set([obj[self.column] for obj in objs if obj[self.column] is not None]))
+        found = dict(zip(keys, self.model.get_many(keys)))
+        for obj in objs:
+            self._attach(obj, found.get(obj[self.column]))
+        return [x for x in found.itervalues() if x is not None]
+
+
+class HasMany(_Relation):
+    '''
+    List of the instances of model whose column is the primary key of the
+    instance, ordered by order_by.
+
+    class Blog(Model):
+        comments = HasMany('Comment', 'blog_id', order_by='created_at desc')
+    '''
+
+    def __init__(self, model, column, order_by=None):
+        super(HasMany, self).__init__(model, column)
+        self.order_by = order_by
+
+    def prefetch(self, objs, chunk_size=500):
+        '''
+        Attach the list of related instances to each of objs with one
+        'where column in (...)' select per chunk_size instances. Return all
+        related instances.
+        '''
+        model = self.model
+        pks = list(set([obj[obj.__primary_key__.name] for obj in objs]))
+        groups = dict([(pk, []) for pk in pks])
+        order_by = ' order by %s' % self.order_by if self.order_by else ''
+        chunk_size = min(chunk_size, db.engine.max_params)
+        children = []
+        for i in range(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            children.extend(model.find_by('where `%s` in (%s)%s' % (self.column, ','.join('?' * len(chunk)), order_by),
+                                          *chunk))
+        for child in children:
+            groups[child[self.column]].append(child)
+        for obj in objs:
+            self._attach(obj, groups[obj[obj.__primary_key__.name]])
+        return children
+
+
+def _prefetch(objs, paths):
+    '''
+    Attach the relations named by paths to objs, with one select per
+    relation and level: 'comments.user' prefetches the comments of objs,
+    then the users of all these comments.
+
+    >>> r = db.update('create table pet (id int primary key, owner_id int, name text)')
+    >>> class Owner(Model):
+    ...     __table__ = 'user'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     pets = HasMany('Pet', 'owner_id', order_by='id')
+    >>> class Pet(Model):
+    ...     id = IntegerField(primary_key=True)
+    ...     owner_id = IntegerField()
+    ...     name = StringField()
+    ...     owner = ForeignKey('Owner', 'owner_id')
+    >>> for id, name in ((10490, 'Ann'), (10491, 'Ben')):
+    ...     r = db.insert('user', id=id, name=name, email='', passwd='', last_modified=0)
+    >>> for id, owner_id, name in ((1, 10490, 'Tom'), (2, 10491, 'Rex'), (3, 10490, 'Kit')):
+    ...     r = Pet(id=id, owner_id=owner_id, name=name).insert()
+    >>> L = Owner.find_by('where id in (?,?,?) order by id', 10490, 10491, 10492, prefetch=['pets.owner'])
+    >>> [(o.name, [(p.name, p.owner.name) for p in o.pets]) for o in L]
+    [(u'Ann', [(u'Tom', u'Ann'), (u'Kit', u'Ann')]), (u'Ben', [(u'Rex', u'Ben')])]
+    >>> Pet.get(2).owner.name
+    u'Ben'
+    >>> r = db.update('delete from user where id in (?,?)', 10490, 10491)
+    >>> r = db.update('drop table pet')
+    '''
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    _prefetch_tree(objs, tree)
+
+
+def _prefetch_tree(objs, tree):
+    if not objs:
+        return
+    relations = objs[0].__relations__
+    for name, subtree in tree.iteritems():
+        if not name in relations:
+            raise ValueError('Unknown relation of %s: %s' % (objs[0].__class__.__name__, name))
+        _prefetch_tree(relations[name].prefetch(objs), subtree)
+
+
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
 
-def _gen_sql(table_name, mappings):
+_SQLITE_TYPES = (
+    (re.compile(r'^(tiny|small|medium|big)?int(eger)?\b|^bool', re.I), 'integer'),
+    (re.compile(r'^(var)?char\b|^(tiny|medium|long)?text$', re.I), 'text'),
+    (re.compile(r'^(real|float|double)\b', re.I), 'real'),
+    (re.compile(r'^(tiny|medium|long)?blob$', re.I), 'blob'),
+)
+
+
+def _sqlite_ddl(ddl):
+    '''
+    Map MySQL column type to SQLite type affinity.
+
+    >>> _sqlite_ddl('varchar(50)'), _sqlite_ddl('mediumtext'), _sqlite_ddl('bool'), _sqlite_ddl('real')
+    ('text', 'text', 'integer', 'real')
+    '''
+    for r, t in _SQLITE_TYPES:
+        if r.match(ddl):
+            return t
+    return ddl
+
+
+def _gen_keys(mappings, indexes):
+    '''
+    Return the secondary keys of a model as list of (columns, unique): from
+    fields declared with index=True or unique=True, then from __indexes__,
+    a list of tuples of field names.
+    '''
+    keys = []
+    for f in sorted(mappings.values(), key=lambda f: f._order):
+        if (f.index or f.unique) and not f.primary_key:
+            keys.append(((f.name,), bool(f.unique)))
+    for columns in indexes:
+        for k in columns:
+            if not k in mappings:
+                raise TypeError('Unknown field in __indexes__: %s' % k)
+        keys.append((tuple([mappings[k].name for k in columns]), False))
+    return keys
+
+
+def _index_name(table_name, columns, dialect='mysql'):
+    # sqlite index names are global to the database:
+    if dialect == 'mysql':
+        return 'idx_%s' % '_'.join(columns)
+    return 'idx_%s_%s' % (table_name, '_'.join(columns))
+
+
+def _gen_index_sql(table_name, columns, unique, dialect='mysql'):
+    return 'create %sindex `%s` on `%s` (%s);' % ('unique ' if unique else '', _index_name(table_name, columns, dialect),
+                                                table_name, ', '.join(['`%s`' % c for c in columns]))
+
+
+def _gen_column(f, dialect='mysql'):
+    if not hasattr(f, 'ddl'):
+        raise StandardError('no ddl in field "%s".' % f.name)
+    ddl = f.ddl if dialect == 'mysql' else _sqlite_ddl(f.ddl)
+    return f.nullable and '`%s` %s' % (f.name, ddl) or '`%s` %s not null' % (f.name, ddl)
+
+
+def _gen_sql(table_name, mappings, dialect='mysql', keys=()):
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
     for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
-        if not hasattr(f, 'ddl'):
-            raise StandardError('no ddl in field "%s".' % n)
-        ddl = f.ddl
-        nullable = f.nullable
         if f.primary_key:
             pk = f.name
-        sql.append(nullable and '  `%s` %s,' % (f.name, ddl) or '  `%s` %s not null,' % (f.name, ddl))
+        sql.append('  %s,' % _gen_column(f, dialect))
+    if dialect == 'mysql':
+        for columns, unique in keys:
+            sql.append('  %skey `%s` (%s),' % ('unique ' if unique else '', _index_name(table_name, columns),
+                                               ', '.join(['`%s`' % c for c in columns])))
     sql.append('  primary key(`%s`)' % pk)
     sql.append(');')
+    if dialect != 'mysql':
+        for columns, unique in keys:
+            sql.append(_gen_index_sql(table_name, columns, unique, dialect))
     return '\n'.join(sql)
 
 
+def _gen_statements(table_name, primary_key, insertable, updatable):
+    '''
+    Return the SQL templates of a model, built once by the metaclass.
+    'update' takes the set clauses of the changed fields from 'set'.
+
+    >>> f = StringField(name='name')
+    >>> st = _gen_statements('user', IntegerField(name='id'), (('name', f),), (('name', f),))
+    >>> st['insert']
+    'insert into `user` (`name`) values (?)'
+    >>> st['update'] % st['set']['name']
+    'update `user` set `name`=? where `id`=?'
+    '''
+    pk = primary_key.name
+    sets = dict([(k, '`%s`=?' % f.name) for k, f in updatable])
+    update = 'update `%s` set %%s where `%s`=?' % (table_name, pk)
+    return dict(
+        get='select * from `%s` where `%s`=?' % (table_name, pk),
+        insert='insert into `%s` (%s) values (%s)' % (
+            table_name, ','.join(['`%s`' % f.name for k, f in insertable]), ','.join(['?'] * len(insertable))),
+        update=update,
+        update_all=update % ','.join([sets[k] for k, f in updatable]),
+        set=sets,
+        delete='delete from `%s` where `%s`=?' % (table_name, pk),
+        count='select count(`%s`) from `%s`' % (pk, table_name))
+
+
+class _IdentityMapCtx(threading.local):
+    '''
+    Thread local identity map: instances loaded by primary key, keyed by
+    (class, pk), while an identity_map() context is open. Models sharing a
+    table have their own instances but are evicted together.
+    '''
+
+    def __init__(self):
+        self.instances = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cls, pk):
+        if self.instances is None:
+            return None
+        obj = self.instances.get((cls, pk))
+        if obj is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+        return obj
+
+    def add(self, obj):
+        '''
+        Register obj and return it, or return the instance already registered
+        with the same class and primary key.
+        '''
+        if self.instances is None:
+            return obj
+        return self.instances.setdefault((obj.__class__, obj[obj.__primary_key__.name]), obj)
+
+    def evict(self, obj):
+        if self.instances is not None:
+            pk = obj.__primary_key__.name
+            if pk in obj:
+                self._evict(obj.__table__, obj[pk])
+
+    def evict_table(self, table):
+        if self.instances is not None:
+            self._evict(table)
+
+    def _evict(self, table, pk=None):
+        for key in [key for key in self.instances if key[0].__table__ == table and (pk is None or key[1] == pk)]:
+            del self.instances[key]
+
+
+_identity = _IdentityMapCtx()
+
+
+class _IdentityMapScope(object):
+    def __enter__(self):
+        self.should_clear = _identity.instances is None
+        if self.should_clear:
+            _identity.instances = {}
+            _identity.hits = _identity.misses = 0
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        if self.should_clear:
+            logging.info('identity map: %d hits, %d misses.' % (_identity.hits, _identity.misses))
+            _identity.instances = None
+
+
+def identity_map():
+    '''
+    Return a context object that can be used by 'with' statement. Within it,
+    Model.get() and Model.find_first('where pk=?') return the instance
+    already loaded with the same primary key instead of selecting it again.
+    Instances are registered when loaded and evicted by update() and
+    delete(). Nested contexts share the outermost map. Statements executed
+    by db.update() directly are not seen by the map.
+
+    >>> class Pet(Model):
+    ...     __table__ = 'user'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    >>> p = Pet(id=10290, name='Tom', email='tom@db.org', passwd='', last_modified=0).insert()
+    >>> with identity_map():
+    ...     p1 = Pet.get(10290)
+    ...     p2 = Pet.find_first('where id=?', 10290)
+    ...     p1 is p2, _identity.hits
+    (True, 1)
+    >>> class Cat(Model):
+    ...     __table__ = 'user'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    >>> with identity_map():
+    ...     p1 = Pet.get(10290)
+    ...     c = Cat.get(10290)
+    ...     p2 = Pet.find_by('where name=?', 'Tom')[0]
+    ...     type(c).__name__, p1 is p2
+    ('Cat', True)
+    >>> with identity_map():
+    ...     p1 = Pet.get(10290)
+    ...     p1.name = 'Jerry'
+    ...     p1 = p1.update()
+    ...     Pet.get(10290) is p1
+    False
+    >>> Pet.get(10290) is Pet.get(10290)
+    False
+    >>> r = p.delete()
+    '''
+    return _IdentityMapScope()
+
+
+class Count(int):
+    '''
+    Row count that knows if it is an estimate from table statistics.
+
+    >>> n = Count(1200, approximate=True)
+    >>> n + 1, n.approximate, json.dumps(n)
+    (1201, True, '1200')
+    '''
+
+    def __new__(cls, value, approximate=False):
+        obj = int.__new__(cls, value)
+        obj.approximate = approximate
+        return obj
+
+
+class _CountCache(object):
+    '''
+    Row counts of tables for count_all(), kept for ttl seconds and adjusted
+    by inserts and deletes done through the ORM. Writes in a transaction drop
+    the count instead, as they may roll back. Statements executed by
+    db.update() directly are only seen when the count expires.
+    '''
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, table):
+        with self._lock:
+            entry = self._counts.get(table)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._counts[table]
+                return None
+            return entry[0]
+
+    def put(self, table, count, ttl):
+        with self._lock:
+            self._counts[table] = (count, time.time() + ttl)
+
+    def adjust(self, table, delta):
+        with self._lock:
+            entry = self._counts.get(table)
+            if entry is None:
+                return
+            if db.in_transaction():
+                del self._counts[table]
+            else:
+                count = entry[0]
+                self._counts[table] = (Count(max(count + delta, 0), count.approximate), entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+_counts = _CountCache()
+
+
+_NOTHING = frozenset()
+
+# columns compared in a where clause, and where the clause ends:
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<>|!=|<=|>=|<|>|\bin\b|\blike\b|\bbetween\b|\bis\b)', re.I)
+_RE_WHERE_END = re.compile(r'\b(?:order\s+by|group\s+by|limit)\b', re.I)
+
+# (table, where) already reported by _check_index():
+_unindexed = set()
+
+_RE_WHERE_PK = re.compile(r'^\s*where\s+`?(\w+)`?\s*=\s*\?\s*$', re.I)
+_RE_WHERE = re.compile(r'^\s*where\s+(.+)$', re.I | re.S)
+
+
+def page_cursor(obj, order_by='created_at'):
+    '''
+    Return the opaque cursor that seeks past the model instance obj in
+    Model.find_page().
+    '''
+    s = base64.urlsafe_b64encode(json.dumps([getattr(obj, order_by), obj[obj.__primary_key__.name]]))
+    return s.rstrip('=')
+
+
+_CURSOR_TYPES = (basestring, int, long, float)
+
+
+def _decode_cursor(cursor):
+    '''
+    Return (order_by value, primary key) of a cursor.
+
+    >>> _decode_cursor('WzEuNSwgImI0MiJd')
+    (1.5, u'b42')
+    >>> _decode_cursor('nonsense')
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid cursor: nonsense
+    >>> _decode_cursor('W1sxXSwiYSJd')
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid cursor: W1sxXSwiYSJd
+    '''
+    try:
+        s = str(cursor)
+        key, pk = json.loads(base64.urlsafe_b64decode(s + '=' * (-len(s) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    # only scalars can be bound as arguments of the query:
+    if not isinstance(key, _CURSOR_TYPES) or not isinstance(pk, _CURSOR_TYPES):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return key, pk
+
+
 class ModelMetaclass(type):
     '''
     Metaclass for model objects.
     '''
 
     def __new__(cls, name, bases, attrs):
-        # skip base Model class:
-        if name == 'Model':
+        # skip base Model classes:
+        if name in ('_ModelBase', 'Model', 'CompactModel'):
             return type.__new__(cls, name, bases, attrs)
 
         # store all subclasses info:
         if not hasattr(cls, 'subclasses'):
             cls.subclasses = {}
-        if not name in cls.subclasses:
-            cls.subclasses[name] = name
-        else:
+        if name in cls.subclasses:
             logging.warning('Redefine class: %s' % name)
 
         logging.info('Scan ORMapping %s...' % name)
         mappings = dict()
+        relations = dict()
         primary_key = None
         for k, v in attrs.iteritems():
+            if isinstance(v, _Relation):
+                v.name = k
+                relations[k] = v
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
@@ -166,14 +610,459 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__relations__'] = relations
+        # (attribute, field) in order of definition, and the SQL using them:
+        fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)
+        attrs['__insertable__'] = tuple([(k, f) for k, f in fields if f.insertable])
+        attrs['__updatable__'] = tuple([(k, f) for k, f in fields if f.updatable])
+        attrs['__statements__'] = _gen_statements(attrs['__table__'], primary_key, attrs['__insertable__'],
+                                                  attrs['__updatable__'])
+        attrs['__keys__'] = _gen_keys(mappings, attrs.get('__indexes__', ()))
+        attrs['__sql__'] = lambda self, dialect='mysql': _gen_sql(attrs['__table__'], mappings, dialect,
+                                                                  attrs['__keys__'])
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls, name, bases, attrs)
+        # the storage comes with the base class, a dict or slots:
+        compact = any([getattr(b, '__compact__', False) for b in bases])
+        if attrs.get('__compact__', compact) != compact:
+            raise TypeError('Cannot set __compact__ in class %s, derive it from %s instead.' % (
+                name, 'CompactModel' if attrs['__compact__'] else 'Model'))
+        if compact:
+            # a slot per field, wrapped by a _FieldAttribute of the field's name:
+            attrs['__slots__'] = tuple(['_v_%s' % k for k, f in fields])
+        new_cls = type.__new__(cls, name, bases, attrs)
+        if compact:
+            new_cls.__attributes__ = {}
+            for k, f in fields:
+                attr = _FieldAttribute(k, new_cls.__dict__['_v_%s' % k])
+                setattr(new_cls, k, attr)
+                new_cls.__attributes__[k] = attr
+            new_cls.__fields__ = tuple([new_cls.__attributes__[k] for k, f in fields])
+        cls.subclasses[name] = new_cls
+        return new_cls
+
+
+class _FieldAttribute(object):
+    '''
+    Attribute of a field of a CompactModel: stores the value in the slot of
+    the field, tracks changes and loads unloaded fields when first read.
+    '''
+    __slots__ = ('name', 'slot')
+
+    def __init__(self, name, slot):
+        self.name = name
+        self.slot = slot
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            return self.slot.__get__(obj, cls)
+        except AttributeError:
+            if self.name in obj._unloaded:
+                obj._load_unloaded()
+                return self.slot.__get__(obj, cls)
+            raise AttributeError(r"'%s' object has no attribute '%s'" % (obj.__class__.__name__, self.name))
+
+    def __set__(self, obj, value):
+        if obj._dirty is not None:
+            try:
+                changed = self.slot.__get__(obj) != value
+            except AttributeError:
+                changed = True
+            if changed:
+                obj._mark_dirty(self.name)
+        if self.name in obj._unloaded:
+            obj._mark_loaded(self.name)
+        self.slot.__set__(obj, value)
 
 
-class Model(dict):
+class _ModelBase(object):
+    '''
+    ORM methods shared by Model and CompactModel. Subclasses store the field
+    values and support 'key in obj', obj[key] and obj[key] = value.
+    '''
+    __metaclass__ = ModelMetaclass
+    __slots__ = ()
+
+    # seconds count_all() is cached, 0 to always count:
+    __count_ttl__ = 60
+    # True to let count_all() estimate the count of a large table from its statistics:
+    __approximate_count__ = False
+
+    # changed fields, None if not tracked (the instance was constructed), () if none changed:
+    _dirty = None
+    # fields not selected by a find_by(columns=, exclude=), loaded when first read:
+    _unloaded = _NOTHING
+    # instances of relations read or prefetched, by relation name:
+    _related = None
+
+    def _mark_dirty(self, key):
+        dirty = self._dirty
+        if not dirty:
+            dirty = set()
+            object.__setattr__(self, '_dirty', dirty)
+        dirty.add(key)
+
+    def _mark_loaded(self, key):
+        # an assigned field is no longer left out by the projection:
+        object.__setattr__(self, '_unloaded', self._unloaded - frozenset([key]))
+
+    def _clean(self):
+        '''
+        Start tracking changed fields: update() only writes those.
+        '''
+        object.__setattr__(self, '_dirty', ())
+
+    @classmethod
+    def _from_row(cls, row, unloaded=None):
+        '''
+        Build instance from a db.Row without copying it into keyword arguments.
+        unloaded is the set of fields not selected, loaded when first read.
+        '''
+        obj = cls.__new__(cls)
+        obj._fill(row)
+        obj._clean()
+        object.__setattr__(obj, '_unloaded', unloaded or _NOTHING)
+        object.__setattr__(obj, '_related', None)
+        return obj
+
+    @classmethod
+    def _check_index(cls, where):
+        '''
+        Warn once if where compares columns of which none leads an index.
+        '''
+        m = _RE_WHERE.match(where)
+        if m is None or (cls.__table__, where) in _unindexed:
+            return
+        clause = _RE_WHERE_END.split(m.group(1), 1)[0]
+        columns = set([c for c in _RE_WHERE_COLUMN.findall(clause) if c in cls.__mappings__])
+        if not columns:
+            return
+        leading = set([cls.__primary_key__.name] + [key[0][0] for key in cls.__keys__])
+        if not columns & leading:
+            _unindexed.add((cls.__table__, where))
+            logging.warning('no index on `%s` supports: %s' % (cls.__table__, where))
+
+    @classmethod
+    def _projection(cls, columns=None, exclude=None):
+        '''
+        Return the select list of the given fields, or of all fields but
+        exclude, and the set of fields left unloaded. The primary key is
+        always selected.
+        '''
+        if columns is None and not exclude:
+            return '*', None
+        names = cls.__mappings__.keys() if columns is None else list(columns)
+        for name in names + list(exclude or ()):
+            if not name in cls.__mappings__:
+                raise ValueError('Unknown field of %s: %s' % (cls.__name__, name))
+        pk = cls.__primary_key__.name
+        loaded = set(names) - set(exclude or ())
+        loaded.add(pk)
+        unloaded = frozenset(cls.__mappings__) - loaded
+        # keep the order of definition:
+        fields = sorted([f for f in cls.__mappings__.itervalues() if f.name in loaded], key=lambda f: f._order)
+        return ','.join(['`%s`' % f.name for f in fields]), unloaded
+
+    def _load_unloaded(self):
+        '''
+        Select the fields of a partially loaded instance that were left out.
+        '''
+        unloaded = self._unloaded
+        object.__setattr__(self, '_unloaded', _NOTHING)
+        pk = self.__primary_key__.name
+        logging.info('load %s of %s %s...' % (', '.join(sorted(unloaded)), self.__class__.__name__, self[pk]))
+        d = db.select_one('select %s from `%s` where `%s`=?' % (
+            ','.join(['`%s`' % k for k in unloaded]), self.__table__, pk), self[pk])
+        if d is None:
+            raise AttributeError(r"'%s' object %s was deleted" % (self.__class__.__name__, self[pk]))
+        for k, v in d.iteritems():
+            if not k in self:
+                self._put(k, v)
+
+    @classmethod
+    def get(cls, pk):
+        '''
+        Get by primary key.
+        '''
+        obj = _identity.get(cls, pk)
+        if obj is not None:
+            return obj
+        d = db.select_one(cls.__statements__['get'], pk)
+        return _identity.add(cls._from_row(d)) if d else None
+
+    @classmethod
+    def get_many(cls, pks, chunk_size=500):
+        '''
+        Get by list of primary keys with 'where pk in (...)' selects of at
+        most chunk_size keys. Return list in the order of pks, with None for
+        the keys not found. Instances in the identity map are not selected
+        again.
+        '''
+        pk = cls.__primary_key__.name
+        found = {}
+        missing = []
+        for key in pks:
+            if key in found:
+                continue
+            obj = _identity.get(cls, key)
+            found[key] = obj
+            if obj is None:
+                missing.append(key)
+        chunk_size = min(chunk_size, db.engine.max_params)
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            L = db.select('select * from `%s` where `%s` in (%s)' % (cls.__table__, pk, ','.join('?' * len(chunk))),
+                          *chunk)
+            for d in L:
+                found[d[pk]] = _identity.add(cls._from_row(d))
+        return [found[key] for key in pks]
+
+    @classmethod
+    def find_first(cls, where, *args):
+        '''
+        Find by where clause and return one result. If multiple results found,
+        only the first one returned. If no result found, return None.
+        '''
+        if len(args) == 1:
+            m = _RE_WHERE_PK.match(where)
+            if m and m.group(1) == cls.__primary_key__.name:
+                return cls.get(args[0])
+        cls._check_index(where)
+        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
+        return _identity.add(cls._from_row(d)) if d else None
+
+    @classmethod
+    def find_all(cls, *args, **kw):
+        '''
+        Find all and return list. Accepts columns and exclude like find_by.
+        '''
+        return cls.find_by('', **kw)
+
+    @classmethod
+    def find_by(cls, where, *args, **kw):
+        '''
+        Find by where clause and return list. Select only the fields listed
+        in 'columns', or all but the fields listed in 'exclude': the other
+        fields are loaded by another select when first read. Relations listed
+        in 'prefetch', as 'name' or 'name.name' for the next level, are
+        selected for all results at once.
+        '''
+        fields, unloaded = cls._projection(kw.pop('columns', None), kw.pop('exclude', None))
+        prefetch = kw.pop('prefetch', None)
+        if kw:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+        cls._check_index(where)
+        L = db.select('select %s from `%s` %s' % (fields, cls.__table__, where), *args)
+        if unloaded:
+            # partial instances are not shared by the identity map:
+            L = [cls._from_row(d, unloaded) for d in L]
+        else:
+            L = [_identity.add(cls._from_row(d)) for d in L]
+        if prefetch:
+            _prefetch(L, prefetch)
+        return L
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        '''
+        Find by where clause and return a generator of results. Rows are
+        streamed in batches so memory use stays flat for large tables.
+        Accepts columns and exclude like find_by.
+        '''
+        fields, unloaded = cls._projection(kw.pop('columns', None), kw.pop('exclude', None))
+        cls._check_index(where)
+        for d in db.select_iter('select %s from `%s` %s' % (fields, cls.__table__, where), *args, **kw):
+            yield cls._from_row(d, unloaded)
+
+    @classmethod
+    def find_page(cls, where='', *args, **kw):
+        '''
+        Find a page of at most 'limit' results ordered by 'order_by' then
+        primary key, newest first. The page starts after the cursor 'after'
+        (next page) or ends before the cursor 'before' (previous page): the
+        select seeks on the index instead of skipping an offset, so any page
+        costs the same. Return (list, next_cursor, previous_cursor), where a
+        cursor is None if there is no such page. Accepts columns and exclude
+        like find_by.
+        '''
+        order_by = kw.pop('order_by', 'created_at')
+        after = kw.pop('after', None)
+        before = kw.pop('before', None)
+        limit = kw.pop('limit', 20)
+        if not order_by in cls.__mappings__:
+            raise ValueError('Unknown field of %s: %s' % (cls.__name__, order_by))
+        if after and before:
+            raise ValueError('Cannot seek both after and before a cursor.')
+        m = _RE_WHERE.match(where)
+        if where.strip() and not m:
+            raise ValueError('Expect a where clause: %s' % where)
+        conditions = ['(%s)' % m.group(1)] if m else []
+        args = list(args)
+        cursor = after or before
+        if cursor:
+            key, pk_value = _decode_cursor(cursor)
+            op = '<' if after else '>'
+            conditions.append('(`%s`%s? or (`%s`=? and `%s`%s?))' % (
+                order_by, op, order_by, cls.__primary_key__.name, op))
+            args.extend([key, key, pk_value])
+        order = 'asc' if before else 'desc'
+        L = cls.find_by('%s order by `%s` %s, `%s` %s limit ?' % (
+            'where %s' % ' and '.join(conditions) if conditions else '', order_by, order,
+            cls.__primary_key__.name, order), *(args + [limit + 1]), **kw)
+        more = len(L) > limit
+        L = L[:limit]
+        if before:
+            L.reverse()
+        if not L:
+            return L, None, None
+        next_cursor = page_cursor(L[-1], order_by) if more or before else None
+        previous_cursor = page_cursor(L[0], order_by) if more and before or after else None
+        return L, next_cursor, previous_cursor
+
+    @classmethod
+    def count_all(cls):
+        '''
+        Find by 'select count(pk) from table' and return Count. The count is
+        cached for __count_ttl__ seconds. If __approximate_count__ is set,
+        the count is read from the table statistics of MySQL instead and
+        may be off by a large margin.
+        '''
+        n = _counts.get(cls.__table__)
+        if n is not None:
+            return n
+        if cls.__approximate_count__ and db.engine.dialect == 'mysql':
+            n = Count(db.select_int('select table_rows from information_schema.tables '
+                                    'where table_schema=database() and table_name=?', cls.__table__) or 0, True)
+        else:
+            n = Count(db.select_int(cls.__statements__['count']))
+        if cls.__count_ttl__:
+            _counts.put(cls.__table__, n, cls.__count_ttl__)
+        return n
+
+    @classmethod
+    def count_by(cls, where, *args):
+        '''
+        Find by 'select count(pk) from table where ... ' and return int.
+        '''
+        cls._check_index(where)
+        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where),
+                             *args)
+
+    def update(self):
+        '''
+        Write the updatable fields changed since the instance was loaded or
+        inserted, or all of them if it was constructed. Nothing is sent if
+        no field changed.
+        '''
+        self.pre_update and self.pre_update()
+        L = []
+        args = []
+        unloaded = self._unloaded
+        dirty = self._dirty
+        for k, v in self.__updatable__:
+            if not k in unloaded and (dirty is None or k in dirty):
+                if not k in self:
+                    self[k] = v.default
+                L.append(k)
+                args.append(self[k])
+        if not L:
+            return self
+        statements = self.__statements__
+        if len(L) == len(self.__updatable__):
+            sql = statements['update_all']
+        else:
+            sql = statements['update'] % ','.join([statements['set'][k] for k in L])
+        args.append(self[self.__primary_key__.name])
+        _identity.evict(self)
+        db.update(sql, *args)
+        self._clean()
+        return self
+
+    def delete(self):
+        self.pre_delete and self.pre_delete()
+        _identity.evict(self)
+        r = db.update(self.__statements__['delete'], self[self.__primary_key__.name])
+        # a batched delete has no row count yet, but its count is dropped as it is in a transaction:
+        _counts.adjust(self.__table__, -1 if isinstance(r, db.DeferredResult) else -r)
+        return self
+
+    @classmethod
+    def update_where(cls, values, where, *args):
+        '''
+        Set the fields in dict values on all rows matching where with one
+        statement and return the number of rows changed. pre_update is not
+        called, and instances of the table in the identity map are evicted.
+        '''
+        if not values:
+            raise ValueError('No fields to update')
+        if not _RE_WHERE.match(where):
+            raise ValueError('Bad where clause: %s' % where)
+        updatable = dict(cls.__updatable__)
+        for k in values:
+            if not k in updatable:
+                raise ValueError('Field is not updatable: %s' % k)
+        keys = values.keys()
+        cls._check_index(where)
+        _identity.evict_table(cls.__table__)
+        return db.update('update `%s` set %s %s' % (
+            cls.__table__, ','.join(['`%s`=?' % updatable[k].name for k in keys]), where),
+                         *([values[k] for k in keys] + list(args)))
+
+    @classmethod
+    def delete_where(cls, where, *args):
+        '''
+        Delete all rows matching where with one statement and return the
+        number of rows deleted. pre_delete is not called, and instances of
+        the table in the identity map are evicted.
+        '''
+        if not _RE_WHERE.match(where):
+            raise ValueError('Bad where clause: %s' % where)
+        cls._check_index(where)
+        _identity.evict_table(cls.__table__)
+        r = db.update('delete from `%s` %s' % (cls.__table__, where), *args)
+        _counts.adjust(cls.__table__, -1 if isinstance(r, db.DeferredResult) else -r)
+        return r
+
+    def _insert_args(self):
+        '''
+        Return the values of the insertable fields in order of definition,
+        after pre_insert and default values are applied.
+        '''
+        self.pre_insert and self.pre_insert()
+        args = []
+        for k, v in self.__insertable__:
+            if not k in self:
+                self[k] = v.default
+            args.append(self[k])
+        return args
+
+    def _insert_params(self):
+        return dict(zip([v.name for k, v in self.__insertable__], self._insert_args()))
+
+    def insert(self):
+        db.update(self.__statements__['insert'], *self._insert_args())
+        _counts.adjust(self.__table__, 1)
+        self._clean()
+        return self
+
+    @classmethod
+    def insert_many(cls, objs, chunk_size=500):
+        '''
+        Insert many objects in one transaction with multi-row inserts.
+        pre_insert and default values are applied to every object first.
+        '''
+        objs = list(objs)
+        db.insert_many(cls.__table__, [obj._insert_params() for obj in objs], chunk_size)
+        _counts.adjust(cls.__table__, len(objs))
+        for obj in objs:
+            obj._clean()
+        return objs
+
+
+class Model(_ModelBase, dict):
     '''
     Base class for ORM.
 
@@ -200,8 +1089,68 @@ class Model(dict):
     u'orm@db.org'
     >>> f.email = 'changed@db.org'
     >>> r = f.update() # change email but email is non-updatable!
+    >>> f.name = 'Michael'
+    >>> f.passwd = 'secret'
+    >>> sorted(f._dirty)
+    ['email', 'passwd']
+    >>> r = f.update()
+    >>> f._dirty, User.get(10190).passwd
+    ((), u'secret')
     >>> len(User.find_all())
     1
+    >>> [u.name for u in User.iter_by('where id=?', 10190)]
+    [u'Michael']
+    >>> p = User.find_by('where id=?', 10190, exclude=['passwd', 'last_modified'])[0]
+    >>> sorted(p.keys())
+    ['email', 'id', 'name']
+    >>> p.passwd
+    u'secret'
+    >>> sorted(p.keys())
+    ['email', 'id', 'last_modified', 'name', 'passwd']
+    >>> sorted(User.find_all(columns=['name'])[0].keys())
+    ['id', 'name']
+    >>> p = User.find_by('where id=?', 10190, columns=['name'])[0]
+    >>> p.passwd = 'NEW'
+    >>> r = p.update()
+    >>> User.get(10190).passwd, p.email
+    (u'NEW', u'orm@db.org')
+    >>> p.passwd = 'secret'
+    >>> r = p.update()
+    >>> L = User.insert_many(User(id=id, name=name) for id, name in ((10191, 'Ada'), (10192, 'Bob')))
+    >>> L[1].passwd
+    '******'
+    >>> User.count_by('where id>?', 10190)
+    2
+    >>> User.count_all()
+    3
+    >>> r = User(id=10193, name='Eve').insert()
+    >>> User.count_all(), _counts.get('user')
+    (4, 4)
+    >>> r = r.delete()
+    >>> L, next, previous = User.find_page(order_by='id', limit=2)
+    >>> [u.id for u in L], previous
+    ([10192, 10191], None)
+    >>> L, next, previous = User.find_page(order_by='id', limit=2, after=next)
+    >>> [u.id for u in L], next
+    ([10190], None)
+    >>> [u.id for u in User.find_page('where id<>?', 10191, order_by='id', limit=2, before=previous)[0]]
+    [10192]
+    >>> [u and u.name for u in User.get_many([10192, 10100, 10191, 10192], chunk_size=2)]
+    [u'Bob', None, u'Ada', u'Bob']
+    >>> with identity_map():
+    ...     b = User.get(10192)
+    ...     User.update_where(dict(name='Zed'), 'where id>?', 10190), User.get(10192).name, b.name
+    (2, u'Zed', u'Bob')
+    >>> User.update_where(dict(email='x@db.org'), 'where id>?', 10190)
+    Traceback (most recent call last):
+      ...
+    ValueError: Field is not updatable: email
+    >>> User.update_where({}, 'where id>?', 10190)
+    Traceback (most recent call last):
+      ...
+    ValueError: No fields to update
+    >>> User.delete_where('where id>?', 10190), User.count_all()
+    (2, 1)
     >>> g = User.get(10190)
     >>> g.email
     u'orm@db.org'
@@ -219,8 +1168,17 @@ class Model(dict):
       `last_modified` real not null,
       primary key(`id`)
     );
+    >>> print User().__sql__('sqlite')
+    -- generating SQL for user:
+    create table `user` (
+      `id` integer not null,
+      `name` text not null,
+      `email` text not null,
+      `passwd` text not null,
+      `last_modified` real not null,
+      primary key(`id`)
+    );
     '''
-    __metaclass__ = ModelMetaclass
 
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -229,99 +1187,252 @@ class Model(dict):
         try:
             return self[key]
         except KeyError:
+            if key in self._unloaded:
+                self._load_unloaded()
+                return self[key]
             raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
-    @classmethod
-    def get(cls, pk):
-        '''
-        Get by primary key.
-        '''
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+    def __setitem__(self, key, value):
+        if self._dirty is not None and (not key in self or dict.__getitem__(self, key) != value):
+            self._mark_dirty(key)
+        if key in self._unloaded:
+            self._mark_loaded(key)
+        dict.__setitem__(self, key, value)
 
-    @classmethod
-    def find_first(cls, where, *args):
-        '''
-        Find by where clause and return one result. If multiple results found,
-        only the first one returned. If no result found, return None.
-        '''
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+    _put = dict.__setitem__
 
-    @classmethod
-    def find_all(cls, *args):
-        '''
-        Find all and return list.
-        '''
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+    def _fill(self, row):
+        dict.update(self, row.iteritems())
 
-    @classmethod
-    def find_by(cls, where, *args):
-        '''
-        Find by where clause and return list.
-        '''
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
 
-    @classmethod
-    def count_all(cls):
-        '''
-        Find by 'select count(pk) from table' and return integer.
-        '''
-        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+class CompactModel(_ModelBase):
+    '''
+    Base class for ORM that stores fields in slots instead of a dict: an
+    instance takes a fraction of the memory of a Model and reads a field
+    without a dict lookup. Only mapped fields can be set, and columns of the
+    table the model does not map are dropped when a row is loaded. obj[key],
+    'key in obj', keys() and iteritems() are supported, and dict(obj)
+    converts it.
 
-    @classmethod
-    def count_by(cls, where, *args):
-        '''
-        Find by 'select count(pk) from table where ... ' and return int.
-        '''
-        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where),
-                             *args)
+    >>> class Note(CompactModel):
+    ...     __table__ = 'user'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField()
+    ...     passwd = StringField(default='')
+    ...     last_modified = FloatField(default=0.0)
+    >>> n = Note(id=10390, name='memo', email='memo@db.org').insert()
+    >>> n.passwd, n['name'], sorted(dict(n).keys())
+    ('', 'memo', ['email', 'id', 'last_modified', 'name', 'passwd'])
+    >>> n.color = 'red'
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'Note' object has no attribute 'color'
+    >>> m = Note.get(10390)
+    >>> m.name = 'todo'
+    >>> sorted(m._dirty)
+    ['name']
+    >>> r = m.update()
+    >>> p = Note.find_by('where id=?', 10390, columns=['name'])[0]
+    >>> p.name, p.email
+    (u'todo', u'memo@db.org')
+    >>> hasattr(p, '__dict__')
+    False
+    >>> class Memo(CompactModel):
+    ...     __table__ = 'user'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    >>> sorted(dict(Memo.get(10390)).keys())
+    ['id', 'name']
+    >>> class Draft(Model):
+    ...     __compact__ = True
+    ...     id = IntegerField(primary_key=True)
+    Traceback (most recent call last):
+        ...
+    TypeError: Cannot set __compact__ in class Draft, derive it from CompactModel instead.
+    >>> r = p.delete()
+    '''
+    __slots__ = ('_dirty', '_unloaded', '_related')
+    __compact__ = True
 
-    def update(self):
-        self.pre_update and self.pre_update()
-        L = []
-        args = []
-        for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
-                L.append('`%s`=?' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
-        return self
+    def __init__(self, **kw):
+        object.__setattr__(self, '_dirty', None)
+        object.__setattr__(self, '_unloaded', _NOTHING)
+        object.__setattr__(self, '_related', None)
+        for k, v in kw.iteritems():
+            self[k] = v
 
-    def delete(self):
-        self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk),)
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
-        return self
+    def __getitem__(self, key):
+        attr = self.__attributes__.get(key)
+        if attr is None:
+            raise KeyError(key)
+        try:
+            return attr.slot.__get__(self)
+        except AttributeError:
+            raise KeyError(key)
 
-    def insert(self):
-        self.pre_insert and self.pre_insert()
-        params = {}
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
-        return self
+    def __setitem__(self, key, value):
+        attr = self.__attributes__.get(key)
+        if attr is None:
+            raise KeyError(key)
+        attr.__set__(self, value)
+
+    def __contains__(self, key):
+        attr = self.__attributes__.get(key)
+        if attr is None:
+            return False
+        try:
+            attr.slot.__get__(self)
+            return True
+        except AttributeError:
+            return False
+
+    def _put(self, key, value):
+        self.__attributes__[key].slot.__set__(self, value)
+
+    def _fill(self, row):
+        attributes = self.__attributes__
+        for k, v in row.iteritems():
+            attr = attributes.get(k)
+            if attr is not None:
+                attr.slot.__set__(self, v)
+
+    def iteritems(self):
+        for attr in self.__fields__:
+            try:
+                yield attr.name, attr.slot.__get__(self)
+            except AttributeError:
+                pass
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [k for k, v in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self.items() == other.items()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % kv for kv in self.iteritems()]))
+
+
+def _read_schema(table_name):
+    '''
+    Return (columns, indexes) of a table in the current database, a set of
+    column names and a list of (columns, unique), or None if no such table.
+    '''
+    if db.engine.dialect == 'mysql':
+        columns = set([r.name for r in db.select('select column_name as name from information_schema.columns '
+                                                 'where table_schema=database() and table_name=?', table_name)])
+        if not columns:
+            return None
+        indexes = {}
+        # MySQL 8 returns the labels of information_schema in upper case unless aliased:
+        for r in db.select('select index_name as name, non_unique as non_unique, column_name as col '
+                           'from information_schema.statistics where table_schema=database() and table_name=? '
+                           'order by index_name, seq_in_index', table_name):
+            indexes.setdefault(r.name, ([], not r.non_unique))[0].append(r.col)
+        return columns, [(tuple(cols), unique) for cols, unique in indexes.values()]
+    columns = set([r.name for r in db.select('pragma table_info(`%s`)' % table_name)])
+    if not columns:
+        return None
+    indexes = []
+    for r in db.select('pragma index_list(`%s`)' % table_name):
+        cols = [c.name for c in sorted(db.select('pragma index_info(`%s`)' % r.name), key=lambda c: c.seqno)]
+        indexes.append((tuple(cols), bool(r.unique)))
+    return columns, indexes
+
+
+def schema_diff(cls):
+    '''
+    Compare a model with its table in the current database and return the
+    statements, one per item, to bring the table up to date: the missing
+    table or columns, then the missing indexes. Nothing is ever dropped.
+
+    >>> class Post(Model):
+    ...     __table__ = 'post'
+    ...     __indexes__ = [('user_id', 'created_at')]
+    ...     id = IntegerField(primary_key=True)
+    ...     user_id = IntegerField()
+    ...     title = StringField(ddl='varchar(50)', unique=True)
+    ...     created_at = FloatField(index=True)
+    >>> len(schema_diff(Post))
+    4
+    >>> r = db.update('create table post (id integer primary key, user_id integer, created_at real)')
+    >>> r = db.update('create index idx_post_created_at on post (created_at)')
+    >>> for sql in schema_diff(Post):
+    ...     print sql
+    alter table `post` add column `title` text not null default '';
+    create unique index `idx_post_title` on `post` (`title`);
+    create index `idx_post_user_id_created_at` on `post` (`user_id`, `created_at`);
+    >>> r = db.update('drop table post')
+    '''
+    dialect = db.engine.dialect
+    table_name = cls.__table__
+    schema = _read_schema(table_name)
+    if schema is None:
+        sql, indexes = [_gen_sql(table_name, cls.__mappings__, dialect)], []
+        columns = cls.__mappings__.keys()
+    else:
+        sql, (columns, indexes) = [], schema
+    for f in sorted(cls.__mappings__.values(), key=lambda f: f._order):
+        if not f.name in columns:
+            # sqlite cannot add a not null column without a default:
+            default = '' if f.nullable or dialect == 'mysql' else " default %s" % (
+                "''" if _sqlite_ddl(f.ddl) == 'text' else '0')
+            sql.append('alter table `%s` add column %s%s;' % (table_name, _gen_column(f, dialect), default))
+    for cols, unique in cls.__keys__:
+        if not [i for i in indexes if i[0] == cols and (i[1] or not unique)]:
+            sql.append(_gen_index_sql(table_name, cols, unique, dialect))
+    return sql
+
+
+def _bench(n=10000):
+    '''
+    Compare memory and attribute reads of Model and CompactModel instances
+    loaded from the same rows.
+    '''
+    import timeit
+
+    db.update('drop table if exists bench')
+    db.update('create table bench (id int primary key, blog_id text, user_id text, user_name text, content text, '
+              'created_at real)')
+    db.insert_many('bench', [dict(id=i, blog_id='b%d' % (i % 10), user_id='u%d' % (i % 100), user_name='Bob',
+                                  content='comment %d' % i, created_at=time.time()) for i in range(n)])
+
+    def fields():
+        return dict(__table__='bench', id=IntegerField(primary_key=True), blog_id=StringField(),
+                    user_id=StringField(), user_name=StringField(), content=TextField(), created_at=FloatField())
+
+    for cls in (type('DictComment', (Model,), fields()), type('SlotComment', (CompactModel,), fields())):
+        L = cls.find_all()
+        size = sum([sys.getsizeof(obj) + sys.getsizeof(getattr(obj, '__dict__', None) or ()) for obj in L])
+        seconds = timeit.timeit(lambda: [obj.user_name for obj in L], number=20)
+        print '%-12s %6d bytes/object %8.1f ns/read' % (cls.__name__, size / len(L), seconds * 1e9 / (20 * len(L)))
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    db.create_engine('www-data', 'www-data', 'test')
+    logging.basicConfig(level=logging.WARNING if 'bench' in sys.argv[1:] else logging.DEBUG)
+    if 'sqlite' in sys.argv[1:]:
+        db.create_engine(driver='sqlite', path=':memory:')
+    else:
+        db.create_engine('www-data', 'www-data', 'test')
+    if 'bench' in sys.argv[1:]:
+        _bench()
+        sys.exit(0)
     db.update('drop table if exists user')
     db.update('create table user (id int primary key, name text, email text, passwd text, last_modified real)')
     import doctest
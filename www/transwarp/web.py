@@ -243,6 +243,9 @@ _RESPONSE_HEADER_DICT = dict(zip(map(lambda x: x.upper(), _RESPONSE_HEADERS), _R
 
 _HEADER_X_POWERED_BY = ('X-Powered-By', 'transwarp/1.0')
 
+# time budget of a request in seconds, set by the proxy in front of us. it can only shorten the budget of the route:
+_HEADER_REQUEST_TIMEOUT = 'X-Request-Timeout'
+
 
 class HttpError(Exception):
     '''
@@ -516,6 +519,27 @@ def post(path):
     return _decorator
 
 
+def timeout(seconds):
+    '''
+    A @timeout decorator that sets the time budget of a route in seconds.
+    The budget is available as ctx.deadline while the request is handled.
+
+    >>> @timeout(2.5)
+    ... @get('/slow')
+    ... def slow():
+    ...     return 'ok'
+    ...
+    >>> slow.__web_timeout__
+    2.5
+    '''
+
+    def _decorator(func):
+        func.__web_timeout__ = seconds
+        return func
+
+    return _decorator
+
+
 _re_route = re.compile(r'(\:[a-zA-Z_]\w*)')
 
 
@@ -563,6 +587,7 @@ class Route(object):
     def __init__(self, func):
         self.path = func.__web_route__
         self.method = func.__web_method__
+        self.timeout = getattr(func, '__web_timeout__', None)
         self.is_static = _re_route.search(self.path) is None
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
@@ -597,6 +622,7 @@ def _static_file_generator(fpath):
 class StaticFileRoute(object):
     def __init__(self):
         self.method = 'GET'
+        self.timeout = None
         self.is_static = False
         self.route = re.compile('^/static/(.+)$')
 
@@ -1448,15 +1474,17 @@ def _load_module(module_name):
 
 
 class WSGIApplication(object):
-    def __init__(self, document_root=None, **kw):
+    def __init__(self, document_root=None, request_timeout=None, **kw):
         '''
         Init a WSGIApplication.
 
         Args:
           document_root: document root path.
+          request_timeout: default time budget of a request in seconds, None for no limit.
         '''
         self._running = False
         self._document_root = document_root
+        self._request_timeout = request_timeout
 
         self._interceptors = []
         self._template_engine = None
@@ -1523,35 +1551,54 @@ class WSGIApplication(object):
 
         _application = Dict(document_root=self._document_root)
 
-        def fn_route():
+        def match_route():
             request_method = ctx.request.request_method
             path_info = ctx.request.path_info
             if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
+                static, dynamic = self._get_static, self._get_dynamic
+            elif request_method == 'POST':
+                static, dynamic = self._post_static, self._post_dynamic
+            else:
+                return None, ()
+            fn = static.get(path_info, None)
+            if fn:
+                return fn, ()
+            for fn in dynamic:
+                args = fn.match(path_info)
+                if args:
+                    return fn, args
+            return None, ()
+
+        def fn_route():
+            fn, args = ctx.route
+            if fn:
+                return fn(*args)
+            if ctx.request.request_method in ('GET', 'POST'):
                 raise notfound()
             raise badrequest()
 
+        def request_deadline(start, fn):
+            timeout = fn.timeout if fn and fn.timeout is not None else self._request_timeout
+            header = ctx.request.header(_HEADER_REQUEST_TIMEOUT)
+            if header is not None:
+                try:
+                    header = float(header)
+                except ValueError:
+                    header = None
+                # any client can send the header: only a finite, positive value that shortens the budget is taken:
+                if header is not None and 0 < header < float('inf') and (timeout is None or header < timeout):
+                    timeout = header
+            return None if timeout is None else start + timeout
+
         fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
 
         def wsgi(env, start_response):
+            start = time.time()
             ctx.application = _application
             ctx.request = Request(env)
             response = ctx.response = Response()
+            ctx.route = match_route()
+            ctx.deadline = request_deadline(start, ctx.route[0])
             try:
                 r = fn_exec()
                 if isinstance(r, Template):
@@ -1571,6 +1618,9 @@ class WSGIApplication(object):
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
                 logging.exception(e)
+                if ctx.deadline is not None and time.time() >= ctx.deadline:
+                    start_response('503 Service Unavailable', [])
+                    return ['<html><body><h1>503 Service Unavailable</h1></body></html>']
                 if not debug:
                     start_response('500 Internal Server Error', [])
                     return ['<html><body><h1>500 Internal Server Error</h1></body></html>']
@@ -1588,6 +1638,8 @@ class WSGIApplication(object):
                 del ctx.application
                 del ctx.request
                 del ctx.response
+                del ctx.route
+                del ctx.deadline
 
         return wsgi
 
@@ -3,10 +3,12 @@
 
 
 import re
-from transwarp.web import get, view, interceptor, post, ctx, view, internalerror, seeother, notfound
+from transwarp.web import get, view, interceptor, post, ctx, view, internalerror, seeother, notfound, forbidden
+from transwarp import db, orm
 from models import User, Blog, Comment
 from config import configs
 import hashlib
+import json
 import logging
 import time
 from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
@@ -57,6 +59,25 @@ def check_admin():
     raise APIPermissionError('No permission')
 
 
+def check_admin_page():
+    user = ctx.request.user
+    if user and user.admin:
+        return
+    raise forbidden()
+
+
+@interceptor('/')
+def deadline_interceptor(next):
+    with db.deadline(ctx.deadline):
+        return next()
+
+
+@interceptor('/')
+def identity_map_interceptor(next):
+    with orm.identity_map():
+        return next()
+
+
 @interceptor('/')
 def user_interceptor(next):
     logging.info('Try to bind user from session cookie...')
@@ -164,11 +185,34 @@ def register():
     return dict()
 
 
-def _get_blogs_by_page():
-    total = Blog.count_all()
+def _find_page(model, **kw):
+    '''
+    Return (items, page) of a list ordered by created_at desc: seek past the
+    'after' or 'before' cursor of the request if given, or skip to the page
+    index. Either way the page carries the cursors of its neighbours.
+    '''
+    total = model.count_all()
+    after = ctx.request.get('after', None)
+    before = ctx.request.get('before', None)
+    if after or before:
+        page = Page(total, None)
+        try:
+            items, next_cursor, previous_cursor = model.find_page(after=after, before=before, limit=page.page_size,
+                                                                  **kw)
+        except ValueError:
+            raise APIValueError('after' if after else 'before', 'Invalid cursor.')
+        return items, Page(total, None, page.page_size, next_cursor, previous_cursor)
     page = Page(total, _get_page_index())
-    blogs = Blog.find_all('order by created_at desc limit ?,?', page.offset, page.limit)
-    return blogs, page
+    items = model.find_by('order by created_at desc, id desc limit ?,?', page.offset, page.limit, **kw)
+    if items:
+        page.next_cursor = orm.page_cursor(items[-1]) if page.has_next else None
+        page.previous_cursor = orm.page_cursor(items[0]) if page.has_previous else None
+    return items, page
+
+
+def _get_blogs_by_page(exclude=('content',)):
+    # list pages only show name and summary, skip the content by default:
+    return _find_page(Blog, exclude=exclude)
 
 
 @get('/manage/')
@@ -210,11 +254,37 @@ def manage_users():
     return dict(page_index=_get_page_index(), user=ctx.request.user)
 
 
+@get('/manage/stats/queries')
+def manage_query_stats():
+    check_admin_page()
+    format = ctx.request.get('format', 'json')
+    if format == 'text':
+        ctx.response.content_type = 'text/plain'
+    else:
+        format = 'json'
+        ctx.response.content_type = 'application/json'
+    return db.dump_query_stats(format)
+
+
+@get('/manage/stats/slow')
+def manage_slow_queries():
+    check_admin_page()
+    ctx.response.content_type = 'application/json'
+    return json.dumps(db.slow_queries(), default=str)
+
+
+@post('/manage/stats/queries/reset')
+def manage_query_stats_reset():
+    check_admin_page()
+    db.reset_query_stats()
+    raise seeother('/manage/stats/queries')
+
+
 @api
 @get('/api/blogs')
 def api_get_blogs():
     format = ctx.request.get('format', '')
-    blogs, page = _get_blogs_by_page()
+    blogs, page = _get_blogs_by_page(exclude=None if format == 'html' else ('content',))
     if format == 'html':
         for blog in blogs:
             blog.content = markdown2.markdown(blog.content)
@@ -281,7 +351,9 @@ def api_delete_blog(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    blog.delete()
+    with db.transaction():
+        Comment.delete_where('where blog_id=?', blog_id)
+        blog.delete()
     return dict(id=blog_id)
 
 
@@ -298,10 +370,16 @@ def api_create_blog_comment(blog_id):
     if not content:
         raise APIValueError('content')
     c = Comment(blog_id=blog_id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
-    c.insert()
+    _insert_comment(c)
     return dict(comment=c)
 
 
+@db.with_transaction(retry=db.RetryPolicy())
+def _insert_comment(comment):
+    # comment bursts on a hot blog contend for the same index pages:
+    comment.insert()
+
+
 @api
 @post('/api/comments/:comment_id/delete')
 def api_delete_comment(comment_id):
@@ -316,18 +394,14 @@ def api_delete_comment(comment_id):
 @api
 @get('/api/comments')
 def api_get_comments():
-    total = Comment.count_all()
-    page = Page(total, _get_page_index())
-    comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    comments, page = _find_page(Comment)
     return dict(comments=comments, page=page)
 
 
 @api
 @get('/api/users')
 def api_get_user():
-    total = User.count_all()
-    page = Page(total, _get_page_index())
-    users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    users, page = _find_page(User)
     for u in users:
         u.password = '******'
     return dict(users=users, page=page)
@@ -40,13 +40,15 @@ def datetime_filter(t):
 db.create_engine(**configs.db)
 
 # init wsgi app:
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), **configs.web)
 
 template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
 template_engine.add_filter('datetime', datetime_filter)
 
 wsgi.template_engine = template_engine
 
+wsgi.add_interceptor(urls.deadline_interceptor)
+wsgi.add_interceptor(urls.identity_map_interceptor)
 # wsgi.add_interceptor(urls.user_interceptor)
 # wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)